@@ -4,6 +4,8 @@ Modified from https://github.com/NVlabs/MUNIT/blob/master/data.py
 import json
 import os
 import os.path
+import tempfile
+import zipfile
 
 import numpy as np
 import torch.utils.data as data
@@ -14,6 +16,27 @@ def default_loader(path):
     return Image.open(path).convert('RGB')
 
 
+def draft_loader(path, new_size=None):
+    """
+    default_loader followed by transforms.Resize(new_size), which then has nothing left to do.
+    JPEGs are decoded with PIL draft mode at the smallest DCT scale (1, 1/2, 1/4 or 1/8) whose
+    size still covers the resized size, the bilinear resize to exactly that size runs on the
+    reduced image. the scaled IDCT only drops detail finer than the reduced grid, most of which the
+    resize removes anyway. against the full decode, 512x512 quality 95 JPEGs resized to 200 differ by
+    0.2-0.4 levels (of 255) on average and up to ~17 on hard edges, blurred noise by 1.1 on
+    average, white noise (the worst case) by 6. other formats are decoded in full
+    """
+    img = Image.open(path)
+    if new_size is None or img.format != 'JPEG':
+        return img.convert('RGB')
+    size = get_resized_size(*img.size, new_size)
+    img.draft('RGB', size)
+    img = img.convert('RGB')
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR)
+    return img
+
+
 def default_flist_reader(flist):
     """
     flist format: impath label\nimpath label\n ...(same to caffe's filelist)
@@ -91,16 +114,16 @@ class ImageLabelFileInfo(data.Dataset):
         return len(self.imgs)
 
 
-def sample_2(num):
-    a = np.random.randint(num)
-    b = (a + 1 + np.random.randint(num-1)) % num
-    return a, b
-
-
 class WCPairDataset(data.Dataset):
+    """
+    (caricature, photo) pairs of the training identities, indexed by (c_idx, p_idx) tuples
+    from IdentityBalancedBatchSampler. the images of class i are
+    c_images[c_offsets[i]:c_offsets[i+1]] and p_images[p_offsets[i]:p_offsets[i+1]]
+    """
     def __init__(self, dataset_path, clear_mode=False, transform=None, loader=default_loader):
         self.transform = transform
         self.loader = loader
+        corrected_names = get_corrected_names(dataset_path) if clear_mode else None
         training_file = os.path.join(
             dataset_path,
             'EvaluationProtocols',
@@ -111,8 +134,10 @@ class WCPairDataset(data.Dataset):
         with open(training_file) as f:
             self.class_num = int(f.readline())
             self.class_names = []
-            self.c_class_images = {}
-            self.p_class_images = {}
+            self.c_images = []
+            self.p_images = []
+            self.c_offsets = np.zeros(self.class_num + 1, dtype=np.int64)
+            self.p_offsets = np.zeros(self.class_num + 1, dtype=np.int64)
             for i in range(self.class_num):
                 words = f.readline().split()
                 class_name = ' '.join(words[:-2])
@@ -121,41 +146,28 @@ class WCPairDataset(data.Dataset):
                     if data_type == 'c':
                         file_string = 'C%05d'
                         img_num = int(words[-2])
+                        images = self.c_images
                     elif data_type == 'p':
                         file_string = 'P%05d'
                         img_num = int(words[-1])
+                        images = self.p_images
                     else:
                         assert 0, 'only support data_type in {c|p}'
 
-                    images = []
                     for j in range(img_num):
-                        if clear_mode:
-                            landmark = load_landmark(os.path.join(dataset_path, 'FacialPoints', class_name, file_string%(j+1)+'.txt'))
-                            if not is_corrected_landmark(landmark):
-                                continue
+                        if clear_mode and class_name+'/'+file_string%(j+1) not in corrected_names:
+                            continue
                         images += [(os.path.join(dataset_path, 'OriginalImages', class_name, file_string%(j+1)+'.jpg'), i)]
-
-                    if data_type == 'c':
-                        self.c_class_images[class_name] = images
-                    else:
-                        self.p_class_images[class_name] = images
+                self.c_offsets[i+1] = len(self.c_images)
+                self.p_offsets[i+1] = len(self.p_images)
 
     def __len__(self):
-        return 10000
+        return len(self.c_images)
 
     def __getitem__(self, idx):
-        if idx % 2 == 0:
-            c1, c2 = sample_2(len(self.class_names))
-            c1 = self.class_names[c1]
-            c2 = self.class_names[c2]
-        else:
-            c = np.random.randint(self.class_num)
-            c1 = self.class_names[c]
-            c2 = self.class_names[c]
-        result1 = np.random.randint(len(self.c_class_images[c1]))
-        result2 = np.random.randint(len(self.p_class_images[c2]))
-        img1, label1 = self.c_class_images[c1][result1]
-        img2, label2 = self.p_class_images[c2][result2]
+        c_idx, p_idx = idx
+        img1, label1 = self.c_images[c_idx]
+        img2, label2 = self.p_images[p_idx]
         img1, img2 = self.loader(img1), self.loader(img2)
         if self.transform is not None:
             img1 = self.transform(img1)
@@ -163,10 +175,72 @@ class WCPairDataset(data.Dataset):
         return (img1, label1), (img2, label2)
 
 
+class IdentityBalancedBatchSampler(data.Sampler):
+    """
+    batches of (c_idx, p_idx) pairs for WCPairDataset, a pos_ratio share of the pairs show the same identity
+    and the others two different ones. the fraction left over by a batch is carried to the next ones, so every
+    batch has batch_size * pos_ratio same identity pairs when that is a whole number, and with batch_size 1
+    and pos_ratio 0.5 same and different pairs alternate.
+    every caricature of an identity having photos is the anchor of one pair per epoch. the anchor order
+    comes from seed and the epoch (set_epoch) so that the num_replicas data-parallel workers take disjoint
+    shards of it, the photos are drawn from seed, epoch and rank
+    """
+    def __init__(self, dataset, batch_size, pos_ratio=0.5, seed=0, num_replicas=1, rank=0, drop_last=True):
+        self.batch_size = batch_size
+        self.pos_ratio = pos_ratio
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.p_offsets = dataset.p_offsets
+        self.p_counts = np.diff(dataset.p_offsets)
+        self.num_photos = int(dataset.p_offsets[-1])
+        c_labels = np.repeat(np.arange(dataset.class_num), np.diff(dataset.c_offsets))
+        self.anchors = np.nonzero(self.p_counts[c_labels] > 0)[0]
+        self.anchor_labels = c_labels[self.anchors]
+        assert np.all(self.p_counts[self.anchor_labels] < self.num_photos), 'negative pairs need photos of two identities'
+        if len(self) == 0:
+            # an empty epoch would make InfiniteSampler and train.train_batches spin forever
+            raise ValueError('%d anchors over %d replicas do not fill a batch of %d' % (
+                len(self.anchors), self.num_replicas, self.batch_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_anchors(self):
+        # the same number of anchors on every replica
+        return len(self.anchors) // self.num_replicas
+
+    def __len__(self):
+        if self.drop_last:
+            return self._num_anchors() // self.batch_size
+        return (self._num_anchors() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.anchors))
+        order = order[self.rank:self._num_anchors() * self.num_replicas:self.num_replicas]
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank])
+        labels = self.anchor_labels[order]
+        starts, counts = self.p_offsets[labels], self.p_counts[labels]
+        # positives: a photo of the same class. negatives: a photo out of the other classes,
+        # drawn from [0, num_photos - counts) and shifted over the anchor's own range
+        positive = starts + (rng.random_sample(len(order)) * counts).astype(np.int64)
+        negative = (rng.random_sample(len(order)) * (self.num_photos - counts)).astype(np.int64)
+        negative += np.where(negative >= starts, counts, 0)
+        # pair i is positive when the expected number of positives (i + 1) * pos_ratio reaches the next whole number
+        num_pos = np.floor(np.arange(len(order) + 1) * self.pos_ratio)
+        is_pos = num_pos[1:] > num_pos[:-1]
+        photos = np.where(is_pos, positive, negative)
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            yield [(int(c), int(p)) for c, p in zip(self.anchors[order[i:i+self.batch_size]], photos[i:i+self.batch_size])]
+
+
 class WCDataset(data.Dataset):
     def __init__(self, dataset_path, is_train, data_type, clear_mode=False, transform=None, loader=default_loader):
         self.transform = transform
         self.loader = loader
+        corrected_names = get_corrected_names(dataset_path) if clear_mode else None
         training_file = os.path.join(
             dataset_path,
             'EvaluationProtocols',
@@ -192,10 +266,8 @@ class WCDataset(data.Dataset):
                     assert 0, 'only support data_type in {c|p}'
                 
                 for j in range(img_num):
-                    if clear_mode:
-                        landmark = load_landmark(os.path.join(dataset_path, 'FacialPoints', class_name, file_string%(j+1)+'.txt'))
-                        if not is_corrected_landmark(landmark):
-                            continue
+                    if clear_mode and class_name+'/'+file_string%(j+1) not in corrected_names:
+                        continue
 
                     self.images += [(os.path.join(dataset_path, 'OriginalImages', class_name, file_string%(j+1)+'.jpg'), i)]
 
@@ -210,92 +282,295 @@ class WCDataset(data.Dataset):
         return img, label
 
 
+###############################################################################
+# Packed dataset
+# pack_wc_dataset decodes and resizes a WebCaricature split once, and writes
+# every image as uint8 into a single flat array file (<pack_path>.npy) with a
+# json index (<pack_path>.json). PackedImages memory-maps that file, so all
+# DataLoader workers share the same pages and no JPEG is decoded while training.
+###############################################################################
+def get_resized_size(w, h, size):
+    # same as transforms.Resize(size) with an int size
+    if (w <= h and w == size) or (h <= w and h == size):
+        return w, h
+    if w < h:
+        return size, int(size * h / w)
+    return int(size * w / h), size
+
+
+def resize_shortest_side(img, size):
+    ow, oh = get_resized_size(*img.size, size)
+    if (ow, oh) == img.size:
+        return img
+    return img.resize((ow, oh), Image.BILINEAR)
+
+
+def image_key(image_path):
+    # 'OriginalImages/<class_name>/C00001.jpg' -> '<class_name>/C00001'
+    class_name = os.path.basename(os.path.dirname(image_path))
+    return class_name + '/' + os.path.splitext(os.path.basename(image_path))[0]
+
+
+def pack_wc_dataset(dataset_path, pack_path, is_train, new_size=None, loader=default_loader):
+    corrected_names = get_corrected_names(dataset_path)
+    entries = []
+    for data_type in ('c', 'p',):
+        dataset = WCDataset(dataset_path, is_train, data_type)
+        for image_path, label in dataset.images:
+            entries.append([image_key(image_path), label, data_type, image_key(image_path) in corrected_names])
+
+    # first pass only reads the headers to get the final sizes
+    offset = 0
+    for entry in entries:
+        with Image.open(os.path.join(dataset_path, 'OriginalImages', entry[0]+'.jpg')) as img:
+            w, h = img.size
+        if new_size is not None:
+            w, h = get_resized_size(w, h, new_size)
+        entry += [offset, h, w]
+        offset += h * w * 3
+
+    os.makedirs(os.path.dirname(os.path.abspath(pack_path)), exist_ok=True)
+    pack = np.lib.format.open_memmap(pack_path+'.npy', mode='w+', dtype=np.uint8, shape=(offset,))
+    for name, _, _, _, offset, h, w in entries:
+        img = loader(os.path.join(dataset_path, 'OriginalImages', name+'.jpg'))
+        if new_size is not None:
+            img = resize_shortest_side(img, new_size)
+        pack[offset:offset+h*w*3] = np.asarray(img, dtype=np.uint8).reshape(-1)
+    pack.flush()
+    del pack
+
+    with open(pack_path+'.json', 'w') as f:
+        json.dump({
+            'dataset_path': dataset_path,
+            'is_train': is_train,
+            'new_size': new_size,
+            'columns': ['name', 'label', 'data_type', 'corrected', 'offset', 'height', 'width'],
+            'images': entries,
+        }, f)
+
+
+def get_pack_path(pack_root, is_train):
+    return os.path.join(pack_root, 'DevTrain' if is_train else 'DevTest')
+
+
+class PackedImages(object):
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        with open(pack_path+'.json') as f:
+            info = json.load(f)
+        self.new_size = info['new_size']
+        self.images = info['images']
+        self.name_to_idx = {image[0]: i for i, image in enumerate(self.images)}
+        self.pack = None
+
+    def check_new_size(self, new_size):
+        # images packed at another size would be resized a second time by the transform
+        assert self.new_size is None or self.new_size == new_size, \
+            'pack %s has new_size %s but the config has %s, rebuild it with ' \
+            '`python data.py --data_root ... --pack_root ... --new_size %s`' % (self.pack_path, self.new_size, new_size, new_size)
+        return self
+
+    def __getstate__(self):
+        # never pickle the mapped array, every worker maps the file by itself
+        state = self.__dict__.copy()
+        state['pack'] = None
+        return state
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        if self.pack is None:
+            self.pack = np.load(self.pack_path+'.npy', mmap_mode='r')
+        offset, h, w = self.images[idx][4:7]
+        return Image.fromarray(self.pack[offset:offset+h*w*3].reshape(h, w, 3), 'RGB')
+
+    def __call__(self, image_path):
+        # can be used as the loader of WCDataset and WCPairDataset
+        return self[self.name_to_idx[image_key(image_path)]]
+
+
+class WCPackedDataset(data.Dataset):
+    def __init__(self, pack_path, data_type, clear_mode=False, transform=None):
+        assert data_type in ('c', 'p',), 'only support data_type in {c|p}'
+        self.transform = transform
+        self.packed_images = PackedImages(pack_path)
+        self.images = [
+            (i, image[1]) for i, image in enumerate(self.packed_images.images)
+            if image[2] == data_type and (image[3] or not clear_mode)
+        ]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        pack_idx, label = self.images[idx]
+        img = self.packed_images[pack_idx]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, label
+
+
 def load_landmark(landmark_file_path):
     return [
         tuple(map(float, landmark.strip().split(' '))) for landmark in open(landmark_file_path).readlines()
     ]
 
 
+###############################################################################
+# Landmark index
+# All FacialPoints txt files of a dataset compiled into one (N, 17, 2) float32
+# array plus the image names ('<class_name>/C00001'). The index is cached in
+# <dataset_path>/FacialPoints.npz and rebuilt when any landmark file or
+# folder is newer than the cache. The cache is written to a temporary file and
+# renamed, so processes building it at the same time never read a partial one,
+# and a read-only dataset folder keeps the index in memory only.
+###############################################################################
+_landmark_indexes = {}
+
+
+def get_landmark_mtime(landmarks_dir):
+    mtime = os.stat(landmarks_dir).st_mtime
+    for class_entry in os.scandir(landmarks_dir):
+        if not class_entry.is_dir():
+            continue
+        mtime = max(mtime, class_entry.stat().st_mtime)
+        for entry in os.scandir(class_entry.path):
+            mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+def build_landmark_index(dataset_path):
+    landmarks_dir = os.path.join(dataset_path, 'FacialPoints')
+    names, landmarks = [], []
+    for class_name in sorted(os.listdir(landmarks_dir)):
+        class_dir = os.path.join(landmarks_dir, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        for filename in sorted(os.listdir(class_dir)):
+            if not filename.endswith('.txt'):
+                continue
+            names.append(class_name + '/' + os.path.splitext(filename)[0])
+            landmarks.append(load_landmark(os.path.join(class_dir, filename)))
+    return names, np.array(landmarks, dtype=np.float32).reshape(-1, 17, 2)
+
+
+def save_landmark_index(index_path, names, landmarks):
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(index_path))
+    except OSError:
+        return    # not writable
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=np.str_), landmarks=landmarks)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass    # e.g. out of space, the index stays in memory
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_landmark_index(dataset_path):
+    """
+    return (name_to_idx, landmarks), landmarks[name_to_idx['<class_name>/C00001']] is the (17, 2) landmark
+    """
+    if dataset_path in _landmark_indexes:
+        return _landmark_indexes[dataset_path]
+
+    index_path = os.path.join(dataset_path, 'FacialPoints.npz')
+    mtime = get_landmark_mtime(os.path.join(dataset_path, 'FacialPoints'))
+    names = None
+    if os.path.exists(index_path) and os.stat(index_path).st_mtime >= mtime:
+        try:
+            with np.load(index_path) as index:
+                names, landmarks = list(index['names']), index['landmarks']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            names = None    # damaged cache, rebuilt below
+    if names is None:
+        names, landmarks = build_landmark_index(dataset_path)
+        save_landmark_index(index_path, names, landmarks)
+
+    _landmark_indexes[dataset_path] = {name: i for i, name in enumerate(names)}, landmarks
+    return _landmark_indexes[dataset_path]
+
+
+def get_corrected_names(dataset_path):
+    # names of all images whose landmark pass is_corrected_landmark
+    name_to_idx, landmarks = load_landmark_index(dataset_path)
+    corrected = is_corrected_landmark(landmarks)
+    return set(name for name, i in name_to_idx.items() if corrected[i])
+
+
 def check_landmark_position(landmark):
-    landmark = np.array(landmark)
+    # landmark: (17, 2) or (N, 17, 2), return a bool or a (N,) bool array
+    landmark = np.asarray(landmark)
+    x, y = landmark[..., 0], landmark[..., 1]
 
     # check 1, 2, 3, 4
-    if not (landmark[0, 1] <= np.min(landmark[0:4, 1]) and\
-            landmark[1, 0] <= np.min(landmark[0:4, 0]) and\
-            landmark[2, 1] >= np.max(landmark[0:4, 1]) and\
-            landmark[3, 0] >= np.max(landmark[0:4, 0])):
-        return False
+    valid = (y[..., 0] <= np.min(y[..., 0:4], axis=-1)) & \
+            (x[..., 1] <= np.min(x[..., 0:4], axis=-1)) & \
+            (y[..., 2] >= np.max(y[..., 0:4], axis=-1)) & \
+            (x[..., 3] >= np.max(x[..., 0:4], axis=-1))
 
     # check 5, 6, 7, 8
-    if not (landmark[4, 0] < landmark[5, 0] < landmark[6, 0] < landmark[7, 0]):
-        return False
+    valid &= np.all(np.diff(x[..., 4:8], axis=-1) > 0, axis=-1)
 
     # check 9, 10, 11, 12
-    if not (landmark[8, 0] < landmark[9, 0] < landmark[10, 0] < landmark[11, 0]):
-        return False
+    valid &= np.all(np.diff(x[..., 8:12], axis=-1) > 0, axis=-1)
 
     # check 13, 14, 15, 16, 17
-    if not (landmark[14, 0] < np.min((landmark[12, 0], landmark[13, 0], landmark[15, 0],)) <\
-                              np.max((landmark[12, 0], landmark[13, 0], landmark[15, 0],)) <\
-                              landmark[16, 0] and\
-            landmark[12, 1] < np.min(landmark[13:17, 1])):
-        return False
+    nose_x = x[..., [12, 13, 15]]
+    valid &= (x[..., 14] < np.min(nose_x, axis=-1)) & \
+             (np.min(nose_x, axis=-1) < np.max(nose_x, axis=-1)) & \
+             (np.max(nose_x, axis=-1) < x[..., 16]) & \
+             (y[..., 12] < np.min(y[..., 13:17], axis=-1))
 
     # check horizontal
-    if not (landmark[1, 0] < np.min(landmark[12:16, 0]) < landmark[3, 0]):
-        return False
+    valid &= (x[..., 1] < np.min(x[..., 12:16], axis=-1)) & (np.min(x[..., 12:16], axis=-1) < x[..., 3])
 
     # check vertical
-    if not (landmark[0, 1] < np.min(landmark[4:8, 1]) < np.max(landmark[4:8, 1]) <\
-                             np.min(landmark[8:12, 1]) < np.max(landmark[8:12, 1]) <\
-                             np.min(landmark[12:16, 1]) < np.max(landmark[12:16, 1]) < landmark[2, 1]):
-        return False
-    
-    return True
+    vertical = np.stack([
+        y[..., 0],
+        np.min(y[..., 4:8], axis=-1), np.max(y[..., 4:8], axis=-1),
+        np.min(y[..., 8:12], axis=-1), np.max(y[..., 8:12], axis=-1),
+        np.min(y[..., 12:16], axis=-1), np.max(y[..., 12:16], axis=-1),
+        y[..., 2],
+    ], axis=-1)
+    valid &= np.all(np.diff(vertical, axis=-1) > 0, axis=-1)
+
+    return valid if valid.ndim else bool(valid)
 
 
 def is_corrected_landmark(landmark, offset=2, corrected_rate=0.10, resize_factor=2):
-    def calc_eye_point(landmark, is_right_eye=0):
-        offset = is_right_eye * 2
-        t = np.array([
-            landmark[8+offset],
-            landmark[9+offset],
-        ])
-        return t.mean(axis=0)
-    
-    def get_img5point(landmark):
-        return np.array([
-            calc_eye_point(landmark, is_right_eye=0),       # Left eye
-            calc_eye_point(landmark, is_right_eye=1),       # Right eye
-            landmark[12],                                   # Nose tip
-            landmark[14],                                   # Mouth left corner
-            landmark[16],                                   # Mouth right corner
-        ])
-
-    if not check_landmark_position(landmark):
-        return False
-
-    ref_pts = [
-        [30.2946+offset, 51.6963+offset],
-        [65.5318+offset, 51.5014+offset],
-        [48.0252+offset, 71.7366+offset],
-        [33.5493+offset, 92.3655+offset],
-        [62.7299+offset, 92.2041+offset],
-    ]
+    # landmark: (17, 2) or (N, 17, 2), return a bool or a (N,) bool array
+    landmark = np.asarray(landmark, dtype=np.float64)
+    img5point = np.stack([
+        landmark[..., 8:10, :].mean(axis=-2),           # Left eye
+        landmark[..., 10:12, :].mean(axis=-2),          # Right eye
+        landmark[..., 12, :],                           # Nose tip
+        landmark[..., 14, :],                           # Mouth left corner
+        landmark[..., 16, :],                           # Mouth right corner
+    ], axis=-2)
+
+    ref_pts = np.array([
+        [30.2946, 51.6963],
+        [65.5318, 51.5014],
+        [48.0252, 71.7366],
+        [33.5493, 92.3655],
+        [62.7299, 92.2041],
+    ]) + offset
     w, h = (96+offset*2, 112+offset*2)
-    landmark = get_img5point(landmark)
     w, h = w * resize_factor, h * resize_factor
-    for i, ld in enumerate(ref_pts):
-        ref_pts[i] = [ld[0]*resize_factor, ld[1]*resize_factor]
+    ref_pts = ref_pts * resize_factor
 
-    for ld0, ld1 in zip(ref_pts, landmark):
-        if not (0 <= ld1[0] < w and 0 <= ld1[1] < h):
-            return False
-        ld0, ld1 = np.array(ld0), np.array(ld1)
-        if np.sum((ld0 - ld1) ** 2) * np.pi > w * h * corrected_rate:
-            return False
+    valid = check_landmark_position(landmark)
+    valid &= np.all((0 <= img5point[..., 0]) & (img5point[..., 0] < w) &
+                    (0 <= img5point[..., 1]) & (img5point[..., 1] < h), axis=-1)
+    valid &= np.all(np.sum((ref_pts - img5point) ** 2, axis=-1) * np.pi <= w * h * corrected_rate, axis=-1)
 
-    return True
+    return valid if valid.ndim else bool(valid)
 
 
 ###############################################################################
@@ -358,3 +633,15 @@ class ImageFolder(data.Dataset):
 
     def __len__(self):
         return len(self.imgs)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--data_root', help='WebCaricature dataset folder, same as data_root in the config')
+    parser.add_argument('--pack_root', help='folder to write the packed train and test splits')
+    parser.add_argument('--new_size', default=None, type=int, help='same as new_size in the config')
+    args = parser.parse_args()
+
+    for is_train in (True, False,):
+        pack_wc_dataset(args.data_root, get_pack_path(args.pack_root, is_train), is_train, args.new_size)
@@ -1,12 +1,14 @@
 """
 Modified from https://github.com/NVlabs/MUNIT/blob/master/networks.py
 """
+import contextlib
 import math
 
 import torch
 import torch.nn.functional as F
 from torch import nn
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 
 ##################################################################################
 # Discriminator
@@ -26,6 +28,7 @@ class MsImageDis(nn.Module):
         self.activ = params['activ']
         self.num_scales = params['num_scales']
         self.pad_type = params['pad_type']
+        self.attention_chunk = params.get('attention_chunk', None)
         self.input_dim = input_dim
         self.downsample = nn.AvgPool2d(3, stride=2, padding=[1, 1], count_include_pad=False)
         self.cnns = nn.ModuleList()
@@ -42,53 +45,74 @@ class MsImageDis(nn.Module):
             cnn_x += [Conv2dBlock(dim, dim * 2, 4, 2, 1, norm=self.norm, activation=self.activ, pad_type=self.pad_type)]
             dim *= 2
         # Self Attention layer
-        cnn_x += [SelfAttention(dim, norm=self.norm)]
+        cnn_x += [SelfAttention(dim, norm=self.norm, chunk_size=self.attention_chunk)]
         cnn_x += [nn.Conv2d(dim, 1, 1, 1, 0)]
         cnn_x = nn.Sequential(*cnn_x)
         return cnn_x
 
-    def forward(self, x):
-        outputs = []
-        for model in self.cnns:
-            outputs.append(model(x))
-            x = self.downsample(x)
+    def build_pyramid(self, x):
+        # the input of every scale, x itself first. a pyramid passed in is returned as is
+        if isinstance(x, (list, tuple)):
+            return x
+        pyramid = [x]
+        for _ in range(self.num_scales - 1):
+            pyramid.append(self.downsample(pyramid[-1]))
+        return pyramid
 
-        return outputs
+    def forward(self, x):
+        # x is an image batch or its pyramid from build_pyramid
+        return [model(x) for model, x in zip(self.cnns, self.build_pyramid(x))]
 
     def calc_dis_loss(self, input_fake, input_real):
-        # calculate the loss to train D
-        outs0 = self.forward(input_fake)
-        outs1 = self.forward(input_real)
+        # calculate the loss to train D, the inputs are image batches or pyramids
+        fakes = self.build_pyramid(input_fake)
+        reals = self.build_pyramid(input_real)
+        if self.norm in ('none', 'sn', 'in', 'ln'):
+            # fake and real go through every scale as one batch, these norms work per sample
+            # so this is the same as two forwards
+            n = fakes[0].size(0)
+            outs = [model(torch.cat([fake, real])) for model, fake, real in zip(self.cnns, fakes, reals)]
+            outs0 = [out[:n] for out in outs]
+            outs1 = [out[n:] for out in outs]
+        else:
+            # bn would normalize fake and real with shared batch statistics
+            outs0, outs1 = self.forward(fakes), self.forward(reals)
         loss = 0
 
-        for it, (out0, out1) in enumerate(zip(outs0, outs1)):
-            if self.gan_type == 'lsgan':
-                loss += torch.mean((out0 - 0)**2) + torch.mean((out1 - 1)**2)
-            elif self.gan_type == 'nsgan':
-                all0 = Variable(torch.zeros_like(out0.data).cuda(), requires_grad=False)
-                all1 = Variable(torch.ones_like(out1.data).cuda(), requires_grad=False)
-                loss += torch.mean(F.binary_cross_entropy(F.sigmoid(out0), all0) +
-                                   F.binary_cross_entropy(F.sigmoid(out1), all1))
-            elif self.gan_type == 'hinge':
-                loss += torch.mean(F.relu(1 + out0)) + torch.mean(F.relu(1 - out1))
-            else:
-                assert 0, "Unsupported GAN type: {}".format(self.gan_type)
+        # the losses are computed in fp32 when the forward runs under autocast
+        with fp32_region(fakes[0].device.type):
+            for it, (out0, out1) in enumerate(zip(outs0, outs1)):
+                out0, out1 = out0.float(), out1.float()
+                if self.gan_type == 'lsgan':
+                    loss += torch.mean((out0 - 0)**2) + torch.mean((out1 - 1)**2)
+                elif self.gan_type == 'nsgan':
+                    all0 = Variable(torch.zeros_like(out0.data), requires_grad=False)
+                    all1 = Variable(torch.ones_like(out1.data), requires_grad=False)
+                    loss += torch.mean(F.binary_cross_entropy(F.sigmoid(out0), all0) +
+                                       F.binary_cross_entropy(F.sigmoid(out1), all1))
+                elif self.gan_type == 'hinge':
+                    loss += torch.mean(F.relu(1 + out0)) + torch.mean(F.relu(1 - out1))
+                else:
+                    assert 0, "Unsupported GAN type: {}".format(self.gan_type)
         return loss
 
     def calc_gen_loss(self, input_fake):
-        # calculate the loss to train G
-        outs0 = self.forward(input_fake)
+        # calculate the loss to train G, input_fake is an image batch or its pyramid
+        fakes = self.build_pyramid(input_fake)
+        outs0 = self.forward(fakes)
         loss = 0
-        for it, (out0) in enumerate(outs0):
-            if self.gan_type == 'lsgan':
-                loss += torch.mean((out0 - 1)**2) # LSGAN
-            elif self.gan_type == 'nsgan':
-                all1 = Variable(torch.ones_like(out0.data).cuda(), requires_grad=False)
-                loss += torch.mean(F.binary_cross_entropy(F.sigmoid(out0), all1))
-            elif self.gan_type == 'hinge':
-                loss += -torch.mean(out0)
-            else:
-                assert 0, "Unsupported GAN type: {}".format(self.gan_type)
+        with fp32_region(fakes[0].device.type):
+            for it, (out0) in enumerate(outs0):
+                out0 = out0.float()
+                if self.gan_type == 'lsgan':
+                    loss += torch.mean((out0 - 1)**2) # LSGAN
+                elif self.gan_type == 'nsgan':
+                    all1 = Variable(torch.ones_like(out0.data), requires_grad=False)
+                    loss += torch.mean(F.binary_cross_entropy(F.sigmoid(out0), all1))
+                elif self.gan_type == 'hinge':
+                    loss += -torch.mean(out0)
+                else:
+                    assert 0, "Unsupported GAN type: {}".format(self.gan_type)
         return loss
 
     def get_info(self):
@@ -114,16 +138,23 @@ class AdaINGen(nn.Module):
         activ = params['activ']
         pad_type = params['pad_type']
         mlp_dim = params['mlp_dim']
+        attention_chunk = params.get('attention_chunk', None)
 
         # style encoder
         self.enc_style = StyleEncoder(4, input_dim, dim, style_dim, norm='none', activ=activ, pad_type=pad_type)
 
         # content encoder
-        self.enc_content = ContentEncoder(n_downsample, n_res, input_dim, dim, 'in', activ, pad_type=pad_type)
-        self.dec = Decoder(n_downsample, n_res, self.enc_content.output_dim, input_dim, res_norm='adain', activ=activ, pad_type=pad_type)
+        self.enc_content = ContentEncoder(n_downsample, n_res, input_dim, dim, 'in', activ, pad_type=pad_type,
+                                          attention_chunk=attention_chunk)
+        self.dec = Decoder(n_downsample, n_res, self.enc_content.output_dim, input_dim, res_norm='adain', activ=activ, pad_type=pad_type,
+                           attention_chunk=attention_chunk)
 
         # MLP to generate AdaIN parameters
         self.mlp = MLP(style_dim, self.get_num_adain_params(self.dec), mlp_dim, 3, norm='none', activ=activ)
+        # the AdaIN layers of the decoder and the size of every mean/std slice of the mlp output, resolved once.
+        # a plain list so that the layers are not registered twice
+        self.adain_layers = [m for m in self.dec.modules() if isinstance(m, AdaptiveInstanceNorm2d)]
+        self.adain_splits = [n for m in self.adain_layers for n in (m.num_features, m.num_features)]
 
         self.gammas = [param for name, param in self.named_parameters() if 'gamma' in name and 'norm' not in name]
         self.total_count, self.accepted_count = 0, 0
@@ -140,23 +171,35 @@ class AdaINGen(nn.Module):
         content = self.enc_content(images)
         return content, style_fake
 
+    def encode_content(self, images):
+        # encode an image to its content code only, skip the style encoder
+        return self.enc_content(images)
+
     def decode(self, content, style):
         # decode content and style codes to an image
         adain_params = self.mlp(style)
-        self.assign_adain_params(adain_params, self.dec)
+        self.assign_adain_params(adain_params)
         images = self.dec(content)
         return images
 
-    def assign_adain_params(self, adain_params, model):
-        # assign the adain_params to the AdaIN layers in model
-        for m in model.modules():
-            if m.__class__.__name__ == "AdaptiveInstanceNorm2d":
-                mean = adain_params[:, :m.num_features]
-                std = adain_params[:, m.num_features:2*m.num_features]
-                m.bias = mean.contiguous().view(-1)
-                m.weight = std.contiguous().view(-1)
-                if adain_params.size(1) > 2*m.num_features:
-                    adain_params = adain_params[:, 2*m.num_features:]
+    def decode_many(self, content, styles):
+        # decode every content code with each of K style codes in a single decoder pass.
+        # content: (N, C, H, W), styles: (K, N or 1, style_dim, 1, 1) tensor or a list of K style batches,
+        # returns (K, N, input_dim, H', W') images, [k, i] is content i with style k
+        if not torch.is_tensor(styles):
+            styles = torch.stack([s.expand(content.size(0), *s.size()[1:]) for s in styles])
+        k, n = styles.size(0), content.size(0)
+        styles = styles.expand(k, n, *styles.size()[2:]).reshape(k * n, *styles.size()[2:])
+        contents = content.unsqueeze(0).expand(k, *content.size()).reshape(k * n, *content.size()[1:])
+        images = self.decode(contents, styles)
+        return images.view(k, n, *images.size()[1:])
+
+    def assign_adain_params(self, adain_params):
+        # assign the adain_params to the AdaIN layers of the decoder
+        params = adain_params.split(self.adain_splits, dim=1)
+        for i, m in enumerate(self.adain_layers):
+            m.bias = params[2*i].reshape(-1)
+            m.weight = params[2*i+1].reshape(-1)
 
     def get_num_adain_params(self, model):
         # return the number of AdaIN parameters needed by the model
@@ -170,7 +213,7 @@ class AdaINGen(nn.Module):
         ret = [
             (self.name+'_gamma_%d'%i, float(gamma)) for i, gamma in enumerate(self.gammas)
         ] + [
-            (self.name+'_acc', self.accepted_count / self.total_count)
+            (self.name+'_acc', self.accepted_count / max(self.total_count, 1))
         ]
         self.accepted_count, self.total_count = 0, 0
         return ret
@@ -194,7 +237,7 @@ class VAEGen(nn.Module):
         # This is a reduced VAE implementation where we assume the outputs are multivariate Gaussian distribution with mean = hiddens and std_dev = all ones.
         hiddens = self.encode(images)
         if self.training == True:
-            noise = Variable(torch.randn(hiddens.size()).cuda(hiddens.data.get_device()))
+            noise = Variable(torch.randn_like(hiddens))
             images_recon = self.decode(hiddens + noise)
         else:
             images_recon = self.decode(hiddens)
@@ -202,7 +245,7 @@ class VAEGen(nn.Module):
 
     def encode(self, images):
         hiddens = self.enc(images)
-        noise = Variable(torch.randn(hiddens.size()).cuda(hiddens.data.get_device()))
+        noise = Variable(torch.randn_like(hiddens))
         return hiddens, noise
 
     def decode(self, hiddens):
@@ -233,7 +276,7 @@ class StyleEncoder(nn.Module):
         return self.model(x)
 
 class ContentEncoder(nn.Module):
-    def __init__(self, n_downsample, n_res, input_dim, dim, norm, activ, pad_type):
+    def __init__(self, n_downsample, n_res, input_dim, dim, norm, activ, pad_type, attention_chunk=None):
         super(ContentEncoder, self).__init__()
         self.model = []
         self.model += [Conv2dBlock(input_dim, dim, 7, 1, 3, norm=norm, activation=activ, pad_type=pad_type)]
@@ -244,7 +287,7 @@ class ContentEncoder(nn.Module):
         # residual blocks
         self.model += [ResBlocks(n_res, dim, norm=norm, activation=activ, pad_type=pad_type)]
         # Self Attention layer with ResBlock
-        self.model += [SelfAttention(dim, norm='sn')]
+        self.model += [SelfAttention(dim, norm='sn', chunk_size=attention_chunk)]
         self.model += [ResBlock(dim, norm=norm, activation=activ, pad_type=pad_type)]
         self.model = nn.Sequential(*self.model)
         self.output_dim = dim
@@ -253,14 +296,14 @@ class ContentEncoder(nn.Module):
         return self.model(x)
 
 class Decoder(nn.Module):
-    def __init__(self, n_upsample, n_res, dim, output_dim, res_norm='adain', activ='relu', pad_type='zero'):
+    def __init__(self, n_upsample, n_res, dim, output_dim, res_norm='adain', activ='relu', pad_type='zero', attention_chunk=None):
         super(Decoder, self).__init__()
 
         self.model = []
         # AdaIN residual blocks
         self.model += [ResBlocks(n_res, dim, res_norm, activ, pad_type=pad_type)]
         # Self Attention layer with ResBlock
-        self.model += [SelfAttention(dim, norm='sn')]
+        self.model += [SelfAttention(dim, norm='sn', chunk_size=attention_chunk)]
         self.model += [ResBlock(dim, norm=res_norm, activation=activ, pad_type=pad_type)]
         # upsampling blocks
         for i in range(n_upsample):
@@ -309,8 +352,10 @@ class MLP(nn.Module):
 # Basic Blocks
 ##################################################################################
 class SelfAttention(nn.Module):
-    def __init__(self, input_dim, norm='none', eps=1e-8):
+    # chunk_size=None builds the dense (b, w*h, w*h) attention matrix, otherwise see tiled_attention
+    def __init__(self, input_dim, norm='none', eps=1e-8, chunk_size=None):
         super(SelfAttention, self).__init__()
+        self.chunk_size = chunk_size
 
         self.f_conv = nn.Conv2d(input_dim, input_dim//8, 1)
         self.g_conv = nn.Conv2d(input_dim, input_dim//8, 1)
@@ -330,12 +375,50 @@ class SelfAttention(nn.Module):
         f = self.f_conv(x).view(b, -1, w*h)
         g = self.g_conv(x).view(b, -1, w*h)
         k = self.k_conv(x).view(b, -1, w*h)
-        # attention.shape = (b, w*h, w*h)
-        attention = self.softmax(torch.bmm(f.permute(0, 2, 1), g))
-        out = torch.bmm(k, attention.permute(0, 2, 1)).view(b, c, w, h)
+        if self.chunk_size is None or w*h <= self.chunk_size:
+            # attention.shape = (b, w*h, w*h)
+            attention = self.softmax(torch.bmm(f.permute(0, 2, 1), g))
+            out = torch.bmm(k, attention.permute(0, 2, 1)).view(b, c, w, h)
+        else:
+            out = tiled_attention(f, g, k, self.chunk_size).view(b, c, w, h)
         return self.gamma * out + x
 
 
+def tiled_attention(f, g, k, chunk_size):
+    # bmm(k, softmax(bmm(f', g)).permute(0, 2, 1)) without ever holding the (b, n, n) attention matrix:
+    # the queries are processed chunk_size at a time, and in backward every query block is
+    # recomputed instead of keeping its attention weights alive
+    need_grad = torch.is_grad_enabled() and any(t.requires_grad for t in (f, g, k))
+    outs = []
+    for i in range(0, f.size(2), chunk_size):
+        if need_grad:
+            outs.append(checkpoint(attention_block, f[:, :, i:i+chunk_size], g, k, chunk_size, use_reentrant=False))
+        else:
+            outs.append(attention_block(f[:, :, i:i+chunk_size], g, k, chunk_size))
+    return torch.cat(outs, dim=2)
+
+
+def attention_block(f, g, k, chunk_size):
+    # the output columns of the queries in f, the keys are visited chunk_size at a time with an
+    # online softmax: a running max m, a running denominator l and a rescaled accumulator acc
+    q = f.permute(0, 2, 1)
+    m = l = acc = None
+    for j in range(0, g.size(2), chunk_size):
+        s = torch.bmm(q, g[:, :, j:j+chunk_size])
+        s_max = s.detach().max(dim=2, keepdim=True)[0]
+        m_new = s_max if m is None else torch.max(m, s_max)
+        p = torch.exp(s - m_new)
+        pv = torch.bmm(p, k[:, :, j:j+chunk_size].permute(0, 2, 1))
+        if m is None:
+            l, acc = p.sum(dim=2, keepdim=True), pv
+        else:
+            scale = torch.exp(m - m_new)
+            l = l * scale + p.sum(dim=2, keepdim=True)
+            acc = acc * scale + pv
+        m = m_new
+    return (acc / l).permute(0, 2, 1)
+
+
 class ResBlock(nn.Module):
     def __init__(self, dim, norm='in', activation='relu', pad_type='zero'):
         super(ResBlock, self).__init__()
@@ -513,6 +596,33 @@ class Vgg16(nn.Module):
         return relu5_3
         # return [relu1_2, relu2_2, relu3_3, relu4_3]
 
+
+class VggPreprocess(nn.Module):
+    # utils.vgg_preprocess as a single 1x1 conv with registered buffers:
+    # RGB in [-1, 1] -> BGR in [0, 255] minus the vgg mean
+    def __init__(self):
+        super(VggPreprocess, self).__init__()
+        mean = torch.tensor([103.939, 116.779, 123.680])
+        self.register_buffer('weight', torch.eye(3).flip(1).view(3, 3, 1, 1) * 127.5)
+        self.register_buffer('bias', 127.5 - mean)
+
+    def forward(self, x):
+        return F.conv2d(x, self.weight, self.bias)
+
+
+class SpherefacePreprocess(nn.Module):
+    # utils.sphereface_preprocess with registered buffers: 224 high images are downsampled to 112,
+    # then RGB in [-1, 1] -> BGR, ((x + 1) * 127.5 - 127.5) / 128 as a single 1x1 conv
+    def __init__(self):
+        super(SpherefacePreprocess, self).__init__()
+        self.downsample = nn.AvgPool2d(3, stride=2, padding=[1, 1], count_include_pad=False)
+        self.register_buffer('weight', torch.eye(3).flip(1).view(3, 3, 1, 1) * (127.5 / 128.))
+
+    def forward(self, x):
+        if x.shape[2] == 224:
+            x = self.downsample(x)
+        return F.conv2d(x, self.weight)
+
 ##################################################################################
 # Sphereface network definition
 # https://github.com/clcarwin/sphereface_pytorch/blob/master/net_sphere.py
@@ -652,6 +762,40 @@ class AngleLinear(nn.Module):
         return output # size=(B,Classnum,2)
 
 
+class AngleLoss(nn.Module):
+    # sphereface/net_sphere.py AngleLoss, with a bool target mask and an explicit softmax dim
+    def __init__(self, gamma=0):
+        super(AngleLoss, self).__init__()
+        self.gamma   = gamma
+        self.it = 0
+        self.LambdaMin = 5.0
+        self.LambdaMax = 1500.0
+        self.lamb = 1500.0
+
+    def forward(self, input, target):
+        self.it += 1
+        cos_theta,phi_theta = input
+        target = target.view(-1,1) #size=(B,1)
+
+        index = torch.zeros_like(cos_theta, dtype=torch.bool) #size=(B,Classnum)
+        index.scatter_(1,target,True)
+
+        self.lamb = max(self.LambdaMin,self.LambdaMax/(1+0.1*self.it ))
+        output = cos_theta * 1.0 #size=(B,Classnum)
+        output[index] -= cos_theta[index]*(1.0+0)/(1+self.lamb)
+        output[index] += phi_theta[index]*(1.0+0)/(1+self.lamb)
+
+        logpt = F.log_softmax(output, dim=1)
+        logpt = logpt.gather(1,target)
+        logpt = logpt.view(-1)
+        pt = logpt.detach().exp()
+
+        loss = -1 * (1-pt)**self.gamma * logpt
+        loss = loss.mean()
+
+        return loss
+
+
 ##################################################################################
 # Normalization layers
 ##################################################################################
@@ -664,24 +808,23 @@ class AdaptiveInstanceNorm2d(nn.Module):
         # weight and bias are dynamically assigned
         self.weight = None
         self.bias = None
-        # just dummy buffers, not used
+        # just dummy buffers, not used, kept so that checkpoints keep the same keys
         self.register_buffer('running_mean', torch.zeros(num_features))
         self.register_buffer('running_var', torch.ones(num_features))
 
     def forward(self, x):
         assert self.weight is not None and self.bias is not None, "Please assign weight and bias before calling AdaIN!"
         b, c = x.size(0), x.size(1)
-        running_mean = self.running_mean.repeat(b)
-        running_var = self.running_var.repeat(b)
-
-        # Apply instance norm
-        x_reshaped = x.contiguous().view(1, b * c, *x.size()[2:])
 
-        out = F.batch_norm(
-            x_reshaped, running_mean, running_var, self.weight, self.bias,
-            True, self.momentum, self.eps)
+        # instance norm as batch norm over a (1, b*c, h, w) view: without running stats nothing is
+        # repeated or copied, statistics and the per instance affine stay in one fused kernel.
+        # the instance statistics are computed in fp32 under autocast
+        with fp32_region(x.device.type):
+            out = F.batch_norm(
+                x.float().reshape(1, b * c, *x.size()[2:]), None, None, self.weight.float(), self.bias.float(),
+                True, 0., self.eps)
 
-        return out.view(b, c, *x.size()[2:])
+        return out.view(x.size()).to(x.dtype)
 
     def __repr__(self):
         return self.__class__.__name__ + '(' + str(self.num_features) + ')'
@@ -699,22 +842,38 @@ class LayerNorm(nn.Module):
             self.beta = nn.Parameter(torch.zeros(num_features))
 
     def forward(self, x):
-        shape = [-1] + [1] * (x.dim() - 1)
-        # print(x.size())
-        if x.size(0) == 1:
-            # These two lines run much faster in pytorch 0.4 than the two lines listed below.
-            mean = x.view(-1).mean().view(*shape)
-            std = x.view(-1).std().view(*shape)
-        else:
-            mean = x.view(x.size(0), -1).mean(1).view(*shape)
-            std = x.view(x.size(0), -1).std(1).view(*shape)
+        with fp32_region(x.device.type):
+            return self._forward(x.float()).to(x.dtype)
 
-        x = (x - mean) / (std + self.eps)
+    def _forward(self, x):
+        shape = [-1] + [1] * (x.dim() - 1)
+        # one pass for both statistics (std is unbiased), then normalization and affine as one scale and shift
+        std, mean = torch.std_mean(x.reshape(x.size(0), -1), dim=1)
+        scale = 1 / (std.view(*shape) + self.eps)
+        shift = -mean.view(*shape) * scale
 
         if self.affine:
             shape = [1, -1] + [1] * (x.dim() - 2)
-            x = x * self.gamma.view(*shape) + self.beta.view(*shape)
-        return x
+            scale = scale * self.gamma.view(*shape)
+            shift = shift * self.gamma.view(*shape) + self.beta.view(*shape)
+        return torch.addcmul(shift, x, scale)
+
+def is_autocast(device_type):
+    if not hasattr(torch, 'autocast'):
+        return False
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # pytorch < 2.4
+        return torch.is_autocast_enabled() if device_type == 'cuda' else torch.is_autocast_cpu_enabled()
+
+
+def fp32_region(device_type):
+    # turn autocast off for numerically sensitive code, nothing to do when it isn't running
+    if is_autocast(device_type):
+        return torch.autocast(device_type, enabled=False)
+    return contextlib.nullcontext()
+
 
 def l2normalize(v, eps=1e-12):
     return v / (v.norm() + eps)
@@ -730,6 +889,8 @@ class SpectralNorm(nn.Module):
         self.module = module
         self.name = name
         self.power_iterations = power_iterations
+        # normalized weight reused by eval forwards under no_grad, see _cache_key
+        self._cache = None
         if not self._made_params():
             self._make_params()
 
@@ -738,14 +899,16 @@ class SpectralNorm(nn.Module):
         v = getattr(self.module, self.name + "_v")
         w = getattr(self.module, self.name + "_bar")
 
-        height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(torch.mv(torch.t(w.view(height,-1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height,-1).data, v.data))
+        # the power iteration and sigma stay in fp32 under autocast
+        with fp32_region(w.device.type):
+            height = w.data.shape[0]
+            for _ in range(self.power_iterations):
+                v.data = l2normalize(torch.mv(torch.t(w.view(height,-1).data), u.data))
+                u.data = l2normalize(torch.mv(w.view(height,-1).data, v.data))
 
-        # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
-        sigma = u.dot(w.view(height, -1).mv(v))
-        setattr(self.module, self.name, w / sigma.expand_as(w))
+            # sigma = torch.dot(u.data, torch.mv(w.view(height,-1).data, v.data))
+            sigma = u.dot(w.view(height, -1).mv(v))
+            setattr(self.module, self.name, w / sigma.expand_as(w))
 
     def _made_params(self):
         try:
@@ -776,6 +939,46 @@ class SpectralNorm(nn.Module):
         self.module.register_parameter(self.name + "_bar", w_bar)
 
 
+    def _cache_key(self):
+        # optimizer steps, load_state_dict and the power iteration bump the version of u, v or w_bar,
+        # moving the module to another device or dtype swaps their storage
+        params = [getattr(self.module, self.name + suffix) for suffix in ("_u", "_v", "_bar")]
+        return tuple((p.data_ptr(), p._version) for p in params)
+
+    def fold(self):
+        # bake the normalized weight into the wrapped module as a plain parameter and return that module,
+        # for deployment. the weight is the one the last cached eval forward used if the cache is still
+        # valid, otherwise the one the next eval forward would use
+        if self._cache is not None and self._cache[0] == self._cache_key():
+            w = self._cache[1]
+        else:
+            with torch.no_grad():
+                self._update_u_v()
+                w = getattr(self.module, self.name)
+        delattr(self.module, self.name)
+        for suffix in ("_u", "_v", "_bar"):
+            del self.module._parameters[self.name + suffix]
+        self.module.register_parameter(self.name, nn.Parameter(w.detach().clone()))
+        return self.module
+
     def forward(self, *args):
-        self._update_u_v()
+        if self.training or torch.is_grad_enabled():
+            self._cache = None
+            self._update_u_v()
+        elif self._cache is None or self._cache[0] != self._cache_key():
+            self._update_u_v()
+            self._cache = (self._cache_key(), getattr(self.module, self.name))
+        else:
+            setattr(self.module, self.name, self._cache[1])
         return self.module.forward(*args)
+
+
+def fold_spectral_norm(model):
+    # replace every SpectralNorm in model by its wrapped module with the normalized weight baked in.
+    # the folded model no longer loads training checkpoints (weight_bar/_u/_v are gone)
+    for name, child in model.named_children():
+        if isinstance(child, SpectralNorm):
+            setattr(model, name, child.fold())
+        else:
+            fold_spectral_norm(child)
+    return model
@@ -0,0 +1,50 @@
+"""
+python -m pytest codes/SATNet/test_data.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from data import IdentityBalancedBatchSampler
+
+
+def pair_dataset(c_counts, p_counts):
+    # what IdentityBalancedBatchSampler reads of a WCPairDataset
+    return SimpleNamespace(class_num=len(c_counts), c_offsets=np.concatenate([[0], np.cumsum(c_counts)]),
+                           p_offsets=np.concatenate([[0], np.cumsum(p_counts)]))
+
+
+def positive_flags(dataset, sampler):
+    c_labels = np.repeat(np.arange(dataset.class_num), np.diff(dataset.c_offsets))
+    p_labels = np.repeat(np.arange(dataset.class_num), np.diff(dataset.p_offsets))
+    return [[c_labels[c] == p_labels[p] for c, p in batch] for batch in sampler]
+
+
+def test_positive_share():
+    dataset = pair_dataset([5, 3, 8, 4, 6, 0, 2], [2, 4, 1, 3, 0, 2, 5])
+    for batch_size, pos_ratio in [(1, 0.5), (1, 0.3), (4, 0.5), (3, 0.25)]:
+        sampler = IdentityBalancedBatchSampler(dataset, batch_size, pos_ratio)
+        flags = []
+        for epoch in range(20):
+            sampler.set_epoch(epoch)
+            batches = positive_flags(dataset, sampler)
+            assert len(batches) == len(sampler)
+            if (batch_size * pos_ratio).is_integer():
+                assert all(sum(batch) == batch_size * pos_ratio for batch in batches)
+            flags += sum(batches, [])
+        # the pos_ratio share up to the rounding of every epoch
+        assert abs(np.mean(flags) - pos_ratio) <= 1. / len(sampler) / batch_size, (batch_size, pos_ratio)
+
+
+def test_no_full_batch():
+    dataset = pair_dataset([2, 1], [1, 1])
+    assert len(IdentityBalancedBatchSampler(dataset, 3)) == 1
+    with pytest.raises(ValueError):
+        IdentityBalancedBatchSampler(dataset, 4)
+    with pytest.raises(ValueError):
+        IdentityBalancedBatchSampler(dataset, 2, num_replicas=2)
+    assert len(IdentityBalancedBatchSampler(dataset, 4, drop_last=False)) == 1
@@ -0,0 +1,104 @@
+"""
+python -m pytest codes/SATNet/test_trainer.py
+"""
+import os
+import sys
+
+import torch
+import torch.nn as nn
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import trainer as trainer_module
+from networks import AngleLinear
+from trainer import Trainer
+
+
+def tiny_config(**kwargs):
+    # configs/sphereface.yaml with small networks on the cpu, no sphereface checkpoint needed
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs', 'sphereface.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['gen'].update(dim=8, mlp_dim=16, n_res=1)
+    config['dis'].update(dim=8, n_layer=2)
+    config.update(display_size=2, device='cpu', sph_w=0, sup_w=1)
+    config.update(kwargs)
+    return config
+
+
+def step_losses(state, precision, seed=0):
+    # D and G loss of one Trainer.step from the given weights, inputs and noise
+    config = tiny_config(precision=precision)
+    trainer = Trainer(config)
+    trainer.load_state_dict(state)
+    generator = torch.Generator().manual_seed(seed)
+    x_a = torch.rand(4, 3, 64, 64, generator=generator) * 2 - 1
+    x_b = torch.rand(4, 3, 64, 64, generator=generator) * 2 - 1
+    # two of the four pairs show the same identity, so the supervised loss is part of the G loss
+    y_a, y_b = torch.tensor([0, 1, 2, 3]), torch.tensor([0, 5, 2, 6])
+    torch.manual_seed(seed)
+    trainer.step(x_a, x_b, y_a, y_b, config)
+    return trainer.loss_dis_total.item(), trainer.loss_gen_total.item()
+
+
+def test_bf16_step_matches_fp32():
+    # bf16 keeps 8 bits of mantissa, the mean losses of one step agree within one bf16 rounding step
+    # (2 ** -8 ~ 4e-3 relative), measured differences are around 1e-4
+    torch.manual_seed(0)
+    state = Trainer(tiny_config()).state_dict()
+    dis_fp32, gen_fp32 = step_losses(state, 'fp32')
+    dis_bf16, gen_bf16 = step_losses(state, 'bf16')
+    assert abs(dis_bf16 - dis_fp32) <= 5e-3 * abs(dis_fp32), (dis_fp32, dis_bf16)
+    assert abs(gen_bf16 - gen_fp32) <= 5e-3 * abs(gen_fp32), (gen_fp32, gen_bf16)
+
+
+class StubSphereface(nn.Module):
+    # stands in for sphere20a, a conv and an AngleLinear with the same (cos_theta, phi_theta) output
+    def __init__(self, classnum=10574, feature=False):
+        super(StubSphereface, self).__init__()
+        self.conv = nn.Conv2d(3, 4, 3, 2, 1)
+        self.pool = nn.AdaptiveAvgPool2d(4)
+        self.fc6 = AngleLinear(4 * 4 * 4, classnum)
+
+    def forward(self, x):
+        return self.fc6(self.pool(self.conv(x)).flatten(1))
+
+
+def sphereface_trainer(tmp_path, monkeypatch):
+    # a Trainer with sph_w > 0 loading a StubSphereface checkpoint
+    monkeypatch.setattr(trainer_module, 'sphere20a', StubSphereface)
+    config = tiny_config(sph_w=1)
+    model_path = str(tmp_path / 'sphereface.pth')
+    torch.manual_seed(0)
+    torch.save(StubSphereface(config['sph']['classnum']).state_dict(), model_path)
+    config['sph'] = dict(config['sph'], model_path=model_path)
+    return Trainer(config), config
+
+
+def test_batched_idt_losses_match_separate(tmp_path, monkeypatch):
+    trainer, _ = sphereface_trainer(tmp_path, monkeypatch)
+    generator = torch.Generator().manual_seed(0)
+    x_ab = torch.rand(3, 3, 64, 64, generator=generator) * 2 - 1
+    x_ba = torch.rand(2, 3, 64, 64, generator=generator) * 2 - 1
+    y_a, y_b = torch.tensor([0, 4, 7]), torch.tensor([1, 4])
+    # AngleLoss anneals with every call, both runs start from the same call count
+    trainer.idt_criterion.it = 0
+    batched = trainer.compute_idt_losses([x_ab, x_ba], [y_a, y_b], [trainer.gen_b, trainer.gen_a])
+    trainer.idt_criterion.it = 0
+    separate = [trainer.compute_idt_loss(x_ab, y_a, trainer.gen_b), trainer.compute_idt_loss(x_ba, y_b, trainer.gen_a)]
+    for loss, expected in zip(batched, separate):
+        assert torch.isfinite(loss)
+        assert torch.allclose(loss, expected, rtol=1e-5, atol=1e-6), (loss, expected)
+    assert (trainer.gen_b.total_count, trainer.gen_a.total_count) == (6, 4)
+
+
+def test_step_with_idt_loss(tmp_path, monkeypatch):
+    trainer, config = sphereface_trainer(tmp_path, monkeypatch)
+    generator = torch.Generator().manual_seed(0)
+    x_a = torch.rand(2, 3, 64, 64, generator=generator) * 2 - 1
+    x_b = torch.rand(2, 3, 64, 64, generator=generator) * 2 - 1
+    trainer.step(x_a, x_b, torch.tensor([0, 1]), torch.tensor([0, 2]), config)
+    assert torch.isfinite(trainer.loss_gen_idt_a) and torch.isfinite(trainer.loss_gen_idt_b)
+    assert torch.isfinite(trainer.loss_gen_total)
+    assert trainer.gen_a.total_count == trainer.gen_b.total_count == 2
+    info = dict(trainer.get_info())
+    assert 0 <= info['gen_a_acc'] <= 1 and 0 <= info['gen_b_acc'] <= 1
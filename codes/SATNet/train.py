@@ -9,96 +9,155 @@ import sys
 import tensorboardX
 import torch
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.autograd import Variable
 
 from trainer import Trainer
-from utils import (Timer, get_all_data_loaders, get_config, prepare_sub_folder,
-                   write_2images, write_html, write_loss)
+from utils import (ImageWriter, Prefetcher, Timer, get_all_data_loaders, get_batch_augment, get_config, get_device,
+                   get_display_images, is_distributed, prepare_sub_folder, write_2images, write_html, write_loss)
 
 cudnn.benchmark = True
 
-def main(opts, yield_mode=False):
+def main(opts, yield_mode=False, async_eval=False):
+    """
+    yield_mode: at every image_save_iter, yield (batches, afid_path, bfid_path) and log the dict sent back
+    async_eval: with yield_mode, yield a CPU snapshot of the generators instead, the receiver sends back
+                a list of (iterations, dict) finished so far, and a final None is yielded to collect the rest
+    """
     # Load experiment setting
     config = get_config(opts.config)
     max_iter = config['max_iter']
     display_size = config['display_size']
     config['vgg_model_path'] = opts.output_path
+    device = get_device(config)
+    # with data-parallel training only rank 0 writes logs, images and checkpoints
+    rank = dist.get_rank() if is_distributed() else 0
 
     # Setup data loader
     trainer = Trainer(config)
-    trainer.cuda()
+    trainer.to(device)
     train_loader_a, train_loader_b, test_loader_a, test_loader_b, combine_loader = get_all_data_loaders(config)
-    train_display_images_a = torch.stack([train_loader_a.dataset[i][0] for i in range(display_size)]).cuda()
-    train_display_images_b = torch.stack([train_loader_b.dataset[i][0] for i in range(display_size)]).cuda()
-    test_display_images_a = torch.stack([test_loader_a.dataset[i][0] for i in range(display_size)]).cuda()
-    test_display_images_b = torch.stack([test_loader_b.dataset[i][0] for i in range(display_size)]).cuda()
-    print('train a images number is', len(train_loader_a.dataset))
-    print('train b images number is', len(train_loader_b.dataset))
-    print('test a images number is', len(test_loader_a.dataset))
-    print('test b images number is', len(test_loader_b.dataset))
-
-    data_loader = combine_loader if config['sup_w'] > 0 else zip(train_loader_a, train_loader_b)
+    # with batch_augment the training loaders return uint8 batches, flip, crop and normalize run on the device
+    augment = get_batch_augment(config)
+    train_display_images_a = get_display_images(train_loader_a, display_size, augment).to(device)
+    train_display_images_b = get_display_images(train_loader_b, display_size, augment).to(device)
+    test_display_images_a = get_display_images(test_loader_a, display_size).to(device)
+    test_display_images_b = get_display_images(test_loader_b, display_size).to(device)
+    if rank == 0:
+        print('train a images number is', len(train_loader_a.dataset))
+        print('train b images number is', len(train_loader_b.dataset))
+        print('test a images number is', len(test_loader_a.dataset))
+        print('test b images number is', len(test_loader_b.dataset))
+
+    # supervised training reads (caricature, photo) pairs, same identity pairs are supervised in gen_update
+    paired = config['sup_w'] > 0
+    if rank == 0 and paired:
+        print('train pairs number is', len(combine_loader.dataset))
 
     # Setup logger and output folders
     from git import Repo
     repo = Repo('.')
     model_name = '%s_%s' % (os.path.splitext(os.path.basename(opts.config))[0], str(repo.head.commit))
-    train_writer = tensorboardX.SummaryWriter(os.path.join(opts.output_path + "/logs", model_name))
     output_directory = os.path.join(opts.output_path + "/outputs", model_name)
-    checkpoint_directory, image_directory = prepare_sub_folder(output_directory)
-    shutil.copy(opts.config, os.path.join(output_directory, 'config.yaml')) # copy config file to output folder
+    if rank == 0:
+        train_writer = tensorboardX.SummaryWriter(os.path.join(opts.output_path + "/logs", model_name))
+        checkpoint_directory, image_directory = prepare_sub_folder(output_directory)
+        image_writer = ImageWriter()
+        shutil.copy(opts.config, os.path.join(output_directory, 'config.yaml')) # copy config file to output folder
+    if is_distributed():
+        dist.barrier()
+        checkpoint_directory, image_directory = prepare_sub_folder(output_directory)
 
     # Start training
     iterations = trainer.resume(checkpoint_directory, hyperparameters=config) if opts.resume else 0
-    while True:
-        for it, ((images_a, labels_a), (images_b, labels_b)) in enumerate(zip(train_loader_a, train_loader_b)):
-            trainer.update_learning_rate()
-            images_a, images_b = images_a.cuda().detach(), images_b.cuda().detach()
-            labels_a, labels_b = labels_a.cuda().detach(), labels_b.cuda().detach() 
-
-            with Timer("Elapsed time in update: %f"):
-                # Main training code
+    # batches arrive on the device already, loaded and copied while the previous update runs
+    prefetcher = Prefetcher(train_batches(train_loader_a, train_loader_b, combine_loader, paired), device,
+                            config.get('prefetch', 2))
+    for (images_a, labels_a), (images_b, labels_b) in prefetcher:
+        trainer.update_learning_rate()
+        if augment is not None:
+            images_a, images_b = augment(images_a), augment(images_b)
+
+        with Timer("Elapsed time in update: %f", verbose=rank == 0):
+            # Main training code
+            if config.get('fused_step', True):
+                trainer.step(images_a, images_b, labels_a, labels_b, config)
+            else:
                 trainer.dis_update(images_a, images_b, config)
                 trainer.gen_update(images_a, images_b, labels_a, labels_b, config)
+            if device.type == 'cuda':
                 torch.cuda.synchronize()
 
-            # Dump training stats in log file
-            if (iterations + 1) % config['log_iter'] == 0:
-                print("Iteration: %08d/%08d" % (iterations + 1, max_iter))
-                write_loss(iterations, trainer, train_writer)
-
-            # Write images
-            if (iterations + 1) % config['image_save_iter'] == 0:
-                with torch.no_grad():
-                    test_image_outputs = trainer.sample(test_display_images_a, test_display_images_b)
-                    train_image_outputs = trainer.sample(train_display_images_a, train_display_images_b)
-                write_2images(test_image_outputs, display_size, image_directory, 'test_%08d' % (iterations + 1))
-                write_2images(train_image_outputs, display_size, image_directory, 'train_%08d' % (iterations + 1))
-                # HTML
-                write_html(output_directory + "/index.html", iterations + 1, config['image_save_iter'], 'images')
-                # fid
-                if yield_mode:
-                    paths = trainer.yield_mode_sample(test_loader_a.dataset, test_loader_b.dataset,
-                                                      image_directory, iterations)
-                    paths = list(paths)
-                    paths.append(config['afid_path'])
-                    paths.append(config['bfid_path'])
-                    other_losses = yield paths
-                    write_loss(iterations, None, train_writer, other_losses)
-
-            if (iterations + 1) % config['image_display_iter'] == 0:
-                with torch.no_grad():
-                    image_outputs = trainer.sample(train_display_images_a, train_display_images_b)
-                write_2images(image_outputs, display_size, image_directory, 'train_current')
-
-            # Save network weights
-            if (iterations + 1) % config['snapshot_save_iter'] == 0:
-                trainer.save(checkpoint_directory, iterations)
-
-            iterations += 1
-            if iterations >= max_iter:
-                # sys.exit('Finish training')
-                return
+        # Dump training stats in log file
+        if rank == 0 and (iterations + 1) % config['log_iter'] == 0:
+            print("Iteration: %08d/%08d" % (iterations + 1, max_iter))
+            write_loss(iterations, trainer, train_writer)
+
+        # Write images
+        if rank == 0 and (iterations + 1) % config['image_save_iter'] == 0:
+            with torch.no_grad():
+                test_image_outputs = trainer.sample(test_display_images_a, test_display_images_b)
+                train_image_outputs = trainer.sample(train_display_images_a, train_display_images_b)
+            write_2images(test_image_outputs, display_size, image_directory, 'test_%08d' % (iterations + 1), image_writer)
+            write_2images(train_image_outputs, display_size, image_directory, 'train_%08d' % (iterations + 1), image_writer)
+            # HTML
+            write_html(output_directory + "/index.html", iterations + 1, config['image_save_iter'], 'images')
+            # fid, the receiver consumes the translated test sets batch by batch
+            if yield_mode and async_eval:
+                snapshot = trainer.get_gen_snapshot()
+                snapshot['iterations'] = iterations
+                for it, other_losses in (yield snapshot):
+                    write_loss(it, None, train_writer, other_losses)
+            elif yield_mode:
+                batches = trainer.translate_datasets(test_loader_a.dataset, test_loader_b.dataset)
+                other_losses = yield batches, config['afid_path'], config['bfid_path']
+                write_loss(iterations, None, train_writer, other_losses)
+
+        if rank == 0 and (iterations + 1) % config['image_display_iter'] == 0:
+            with torch.no_grad():
+                image_outputs = trainer.sample(train_display_images_a, train_display_images_b)
+            write_2images(image_outputs, display_size, image_directory, 'train_current', image_writer)
+
+        # Save network weights
+        if rank == 0 and (iterations + 1) % config['snapshot_save_iter'] == 0:
+            trainer.save(checkpoint_directory, iterations)
+
+        iterations += 1
+        if iterations >= max_iter:
+            if rank == 0:
+                image_writer.wait()
+            if yield_mode and async_eval:
+                for it, other_losses in (yield None):
+                    write_loss(it, None, train_writer, other_losses)
+            # sys.exit('Finish training')
+            prefetcher.close()
+            return
+
+
+def train_batches(train_loader_a, train_loader_b, combine_loader, paired):
+    # the training batches of one epoch after the other. with `loader: {infinite: true}` in the config
+    # the first epoch never ends and the loaders keep their workers (the samplers switch epochs)
+    epoch = 0
+    while True:
+        # reshuffle the DistributedSampler shards and redraw the pairs every epoch
+        for loader in (train_loader_a, train_loader_b, combine_loader):
+            for sampler in (loader.sampler, loader.batch_sampler):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
+        epoch += 1
+        for batch in (combine_loader if paired else zip(train_loader_a, train_loader_b)):
+            yield batch
+
+
+def run_worker(local_rank, opts):
+    # one data-parallel worker of `python train.py --nproc N [--nnodes M --node_rank i --master_addr ...]`
+    os.environ['MASTER_ADDR'] = opts.master_addr
+    os.environ['MASTER_PORT'] = opts.master_port
+    dist.init_process_group('gloo', rank=opts.node_rank * opts.nproc + local_rank, world_size=opts.nnodes * opts.nproc)
+    for iterations, images in main(opts):
+        pass
+    dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -107,7 +166,15 @@ if __name__ == '__main__':
     parser.add_argument('--output_path', type=str, default='.', help="outputs path")
     parser.add_argument("--resume", action="store_true")
     # parser.add_argument('--trainer', type=str, default='MUNIT', help="MUNIT|UNIT")
+    parser.add_argument('--nproc', type=int, default=1, help="worker processes on this node, >1 trains data-parallel over gloo")
+    parser.add_argument('--nnodes', type=int, default=1, help="number of nodes")
+    parser.add_argument('--node_rank', type=int, default=0, help="rank of this node")
+    parser.add_argument('--master_addr', type=str, default='127.0.0.1', help="address of the node with node_rank 0")
+    parser.add_argument('--master_port', type=str, default='29500')
     opts = parser.parse_args()
 
-    for iterations, images in main(opts):
-        pass
+    if opts.nproc * opts.nnodes > 1:
+        mp.spawn(run_worker, args=(opts,), nprocs=opts.nproc)
+    else:
+        for iterations, images in main(opts):
+            pass
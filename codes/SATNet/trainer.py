@@ -1,6 +1,7 @@
 """
 Modified from https://github.com/NVlabs/MUNIT/blob/master/trainer.py
 """
+import contextlib
 import os
 
 import numpy as np
@@ -9,9 +10,10 @@ import torch.nn as nn
 import torchvision.utils as vutils
 from torch.autograd import Variable
 from torch.nn import functional as F
+from torch.utils.data import DataLoader
 
-from networks import AdaINGen, MsImageDis, sphere20a
-from utils import get_model_list, get_scheduler, vgg_preprocess, weights_init, sphereface_preprocess
+from networks import AdaINGen, AngleLoss, MsImageDis, SpherefacePreprocess, VggPreprocess, sphere20a
+from utils import all_reduce_gradients, broadcast_module, get_model_list, get_scheduler, is_distributed, weights_init
 
 
 class Trainer(nn.Module):
@@ -25,13 +27,17 @@ class Trainer(nn.Module):
         self.dis_a = MsImageDis(hyperparameters['input_dim_a'], hyperparameters['dis'], name='dis_a')  # discriminator for domain a
         self.dis_b = MsImageDis(hyperparameters['input_dim_b'], hyperparameters['dis'], name='dis_b')  # discriminator for domain b
         self.instancenorm = nn.InstanceNorm2d(512, affine=False)
+        self.vgg_preprocess = VggPreprocess()
+        self.sphereface_preprocess = SpherefacePreprocess()
         self.style_dim = hyperparameters['gen']['style_dim']
-
+        self.device = torch.device(hyperparameters.get('device', 'cuda'))
+        self.precision = hyperparameters.get('precision', 'fp32')
+        assert self.precision in ('fp32', 'bf16'), "Unsupported precision: {}".format(self.precision)
 
         # fix the noise used in sampling
         display_size = int(hyperparameters['display_size'])
-        self.s_a = torch.randn(display_size, self.style_dim, 1, 1).cuda()
-        self.s_b = torch.randn(display_size, self.style_dim, 1, 1).cuda()
+        self.s_a = torch.randn(display_size, self.style_dim, 1, 1, device=self.device)
+        self.s_b = torch.randn(display_size, self.style_dim, 1, 1, device=self.device)
 
         # Setup the optimizers
         beta1 = hyperparameters['beta1']
@@ -50,42 +56,92 @@ class Trainer(nn.Module):
         self.dis_a.apply(weights_init('gaussian'))
         self.dis_b.apply(weights_init('gaussian'))
 
+        # data-parallel workers start from rank 0's weights and average their gradients before every step
+        self.distributed = is_distributed()
+        if self.distributed:
+            for net in (self.gen_a, self.gen_b, self.dis_a, self.dis_b):
+                broadcast_module(net)
+
         # load sphereface weight if need
         if hyperparameters['sph_w'] != 0:
             self.sphereface = sphere20a(hyperparameters['sph']['classnum'])
-            self.sphereface.load_state_dict(torch.load(hyperparameters['sph']['model_path']))
-            self.sphereface.feature = True
+            self.sphereface.load_state_dict(torch.load(hyperparameters['sph']['model_path'], map_location='cpu'))
             self.sphereface.eval()
             for param in self.sphereface.parameters():
                 param.requires_grad = False
+            # the translations are classified as the identity of their content image
+            self.idt_criterion = AngleLoss()
+
+    def autocast(self):
+        # forward passes of the updates run under bf16 autocast with precision: bf16,
+        # AdaIN/LayerNorm statistics, the SpectralNorm power iteration and the losses stay in fp32.
+        # bf16 keeps the fp32 exponent range, so no loss scaling is needed
+        if self.precision == 'bf16':
+            return torch.autocast(self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
 
     def recon_criterion(self, input, target):
-        return torch.mean(torch.abs(input - target))
+        return torch.mean(torch.abs(input.float() - target.float()))
 
     def forward(self, x_a, x_b):
         self.eval()
         s_a = Variable(self.s_a)
         s_b = Variable(self.s_b)
-        c_a, s_a_fake = self.gen_a.encode(x_a)
-        c_b, s_b_fake = self.gen_b.encode(x_b)
+        c_a = self.gen_a.encode_content(x_a)
+        c_b = self.gen_b.encode_content(x_b)
         x_ba = self.gen_a.decode(c_b, s_a)
         x_ab = self.gen_b.decode(c_a, s_b)
         self.train()
         return x_ab, x_ba
 
+    def step(self, x_a, x_b, y_a, y_b, hyperparameters):
+        # dis_update followed by gen_update, but the content codes and the
+        # cross domain translations are computed only once and shared by both
+        s_a = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1, device=x_a.device))
+        s_b = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1, device=x_b.device))
+        with self.autocast():
+            # encode
+            c_a, s_a_prime = self.gen_a.encode(x_a)
+            c_b, s_b_prime = self.gen_b.encode(x_b)
+            # decode (cross domain)
+            x_ba = self.gen_a.decode(c_b, s_a)
+            x_ab = self.gen_b.decode(c_a, s_b)
+            # the discriminator inputs of the translations are built once for the D and the G loss
+            pyramid_ba = self.dis_a.build_pyramid(x_ba)
+            pyramid_ab = self.dis_b.build_pyramid(x_ab)
+        # D is updated first, G sees the updated D just like calling dis_update before gen_update
+        self._dis_update(x_a, x_b, [x.detach() for x in pyramid_ba], [x.detach() for x in pyramid_ab], hyperparameters)
+        self._gen_update(x_a, x_b, y_a, y_b, c_a, c_b, s_a_prime, s_b_prime, s_a, s_b, x_ba, x_ab, hyperparameters,
+                         pyramid_ba, pyramid_ab)
+
     def gen_update(self, x_a, x_b, y_a, y_b, hyperparameters):
+        s_a = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1, device=x_a.device))
+        s_b = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1, device=x_b.device))
+        with self.autocast():
+            # encode
+            c_a, s_a_prime = self.gen_a.encode(x_a)
+            c_b, s_b_prime = self.gen_b.encode(x_b)
+            # decode (cross domain)
+            x_ba = self.gen_a.decode(c_b, s_a)
+            x_ab = self.gen_b.decode(c_a, s_b)
+        self._gen_update(x_a, x_b, y_a, y_b, c_a, c_b, s_a_prime, s_b_prime, s_a, s_b, x_ba, x_ab, hyperparameters)
+
+    def _gen_update(self, x_a, x_b, y_a, y_b, c_a, c_b, s_a_prime, s_b_prime, s_a, s_b, x_ba, x_ab, hyperparameters,
+                    pyramid_ba=None, pyramid_ab=None):
         self.gen_opt.zero_grad()
-        s_a = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1).cuda())
-        s_b = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1).cuda())
-        # encode
-        c_a, s_a_prime = self.gen_a.encode(x_a)
-        c_b, s_b_prime = self.gen_b.encode(x_b)
+        with self.autocast():
+            self._gen_losses(x_a, x_b, y_a, y_b, c_a, c_b, s_a_prime, s_b_prime, s_a, s_b, x_ba, x_ab, hyperparameters,
+                             pyramid_ba, pyramid_ab)
+        self.loss_gen_total.backward()
+        if self.distributed:
+            all_reduce_gradients(self.gen_opt)
+        self.gen_opt.step()
+
+    def _gen_losses(self, x_a, x_b, y_a, y_b, c_a, c_b, s_a_prime, s_b_prime, s_a, s_b, x_ba, x_ab, hyperparameters,
+                    pyramid_ba=None, pyramid_ab=None):
         # decode (within domain)
         x_a_recon = self.gen_a.decode(c_a, s_a_prime)
         x_b_recon = self.gen_b.decode(c_b, s_b_prime)
-        # decode (cross domain)
-        x_ba = self.gen_a.decode(c_b, s_a)
-        x_ab = self.gen_b.decode(c_a, s_b)
         # encode again
         c_b_recon, s_a_recon = self.gen_a.encode(x_ba)
         c_a_recon, s_b_recon = self.gen_b.encode(x_ab)
@@ -93,8 +149,11 @@ class Trainer(nn.Module):
         x_aba = self.gen_a.decode(c_a_recon, s_a_prime) if hyperparameters['recon_x_cyc_w'] > 0 else None
         x_bab = self.gen_b.decode(c_b_recon, s_b_prime) if hyperparameters['recon_x_cyc_w'] > 0 else None
         # decode (swap style code)
-        x_ab_prime = self.gen_b.decode(c_a, s_b_prime) if hyperparameters['sup_w'] > 0 and y_a == y_b else None
-        x_ba_prime = self.gen_a.decode(c_b, s_a_prime) if hyperparameters['sup_w'] > 0 and y_a == y_b else None
+        # only the pairs of the batch showing the same identity are decoded and supervised
+        same = (y_a == y_b).nonzero().view(-1) if hyperparameters['sup_w'] > 0 else None
+        sup = same is not None and same.numel() > 0
+        x_ab_prime = self.gen_b.decode(c_a[same], s_b_prime[same]) if sup else None
+        x_ba_prime = self.gen_a.decode(c_b[same], s_a_prime[same]) if sup else None
 
         # reconstruction loss
         self.loss_gen_recon_x_a = self.recon_criterion(x_a_recon, x_a)
@@ -106,18 +165,23 @@ class Trainer(nn.Module):
         self.loss_gen_cycrecon_x_a = self.recon_criterion(x_aba, x_a) if hyperparameters['recon_x_cyc_w'] > 0 else 0
         self.loss_gen_cycrecon_x_b = self.recon_criterion(x_bab, x_b) if hyperparameters['recon_x_cyc_w'] > 0 else 0
         # GAN loss
-        self.loss_gen_adv_a = self.dis_a.calc_gen_loss(x_ba)
-        self.loss_gen_adv_b = self.dis_b.calc_gen_loss(x_ab)
-        # domain-invariant perceptual loss
-        self.loss_gen_vgg_a = self.compute_vgg_loss(self.vgg, x_ba, x_b) if hyperparameters['vgg_w'] > 0 else 0
-        self.loss_gen_vgg_b = self.compute_vgg_loss(self.vgg, x_ab, x_a) if hyperparameters['vgg_w'] > 0 else 0
-        # domain-invariant identity loss
-        self.sphereface.eval()
-        self.loss_gen_idt_a = self.compute_idt_loss(x_ab, x_a, hyperparameters['sph']) if hyperparameters['sph_w'] > 0 else 0
-        self.loss_gen_idt_b = self.compute_idt_loss(x_ba, x_b, hyperparameters['sph']) if hyperparameters['sph_w'] > 0 else 0
+        self.loss_gen_adv_a = self.dis_a.calc_gen_loss(x_ba if pyramid_ba is None else pyramid_ba)
+        self.loss_gen_adv_b = self.dis_b.calc_gen_loss(x_ab if pyramid_ab is None else pyramid_ab)
+        # domain-invariant perceptual loss, both directions in one batch
+        if hyperparameters['vgg_w'] > 0:
+            self.loss_gen_vgg_a, self.loss_gen_vgg_b = self.compute_vgg_losses(self.vgg, [x_ba, x_ab], [x_b, x_a])
+        else:
+            self.loss_gen_vgg_a = self.loss_gen_vgg_b = 0
+        # domain-invariant identity loss, both directions in one batch
+        if hyperparameters['sph_w'] > 0:
+            self.sphereface.eval()
+            self.loss_gen_idt_a, self.loss_gen_idt_b = self.compute_idt_losses(
+                [x_ab, x_ba], [y_a, y_b], [self.gen_b, self.gen_a])
+        else:
+            self.loss_gen_idt_a = self.loss_gen_idt_b = 0
         # supervised loss
-        self.a_supervised_loss = self.recon_criterion(x_ba_prime, x_a) if hyperparameters['sup_w'] > 0 and y_a == y_b else 0
-        self.b_suprrvised_loss = self.recon_criterion(x_ab_prime, x_b) if hyperparameters['sup_w'] > 0 and y_a == y_b else 0
+        self.a_supervised_loss = self.recon_criterion(x_ba_prime, x_a[same]) if sup else 0
+        self.b_suprrvised_loss = self.recon_criterion(x_ab_prime, x_b[same]) if sup else 0
         # total loss
         self.loss_gen_total = hyperparameters['gan_w'] * self.loss_gen_adv_a + \
                               hyperparameters['gan_w'] * self.loss_gen_adv_b + \
@@ -135,91 +199,84 @@ class Trainer(nn.Module):
                               hyperparameters['sup_w'] * self.b_suprrvised_loss + \
                               hyperparameters['vgg_w'] * self.loss_gen_vgg_a + \
                               hyperparameters['vgg_w'] * self.loss_gen_vgg_b
-        self.loss_gen_total.backward()
-        self.gen_opt.step()
 
     def compute_vgg_loss(self, vgg, img, target):
-        img_vgg = vgg_preprocess(img)
-        target_vgg = vgg_preprocess(target)
-        img_fea = vgg(img_vgg)
-        target_fea = vgg(target_vgg)
-        return torch.mean((self.instancenorm(img_fea) - self.instancenorm(target_fea)) ** 2)
+        return self.compute_vgg_losses(vgg, [img], [target])[0]
+
+    def compute_vgg_losses(self, vgg, imgs, targets):
+        # one vgg forward for all imgs, one without grad for all targets (real images)
+        img_fea = vgg(self.vgg_preprocess(torch.cat(imgs)))
+        with torch.no_grad():
+            target_fea = vgg(self.vgg_preprocess(torch.cat(targets)))
+        diff = (self.instancenorm(img_fea) - self.instancenorm(target_fea)) ** 2
+        return [torch.mean(d) for d in diff.split([img.size(0) for img in imgs])]
 
     def compute_idt_loss(self, img, lable, gen):
-        img_sph = sphereface_preprocess(img)
-        img_fea = self.sphereface(img_sph)
-        idt_loss = self.idt_criterion(img_fea[0], lable)
-        gen.total_count += 1
+        return self.compute_idt_losses([img], [lable], [gen])[0]
+
+    def compute_idt_losses(self, imgs, lables, gens):
+        # one sphereface forward for all imgs, the (cos_theta, phi_theta) outputs are split per img.
+        # gens count how many of their translations sphereface assigns to the right identity
+        sizes = [img.size(0) for img in imgs]
+        cos_theta, phi_theta = self.sphereface(self.sphereface_preprocess(torch.cat(imgs)))
+        img_feas = zip(cos_theta.split(sizes), phi_theta.split(sizes))
+        return [self._idt_loss(img_fea, lable, gen) for img_fea, lable, gen in zip(img_feas, lables, gens)]
+
+    def _idt_loss(self, img_fea, lable, gen):
+        # the loss is computed in fp32 when the forward runs under autocast
+        img_fea = tuple(fea.float() for fea in img_fea)
+        idt_loss = self.idt_criterion(img_fea, lable)
+        gen.total_count += lable.size(0)
         gen.accepted_count += int(torch.sum(lable == torch.argmax(img_fea[0], dim=1)))
         return idt_loss
 
-    def yield_mode_sample(self, d_a, d_b, image_directory, iterations):
-        x_a_recon_path = os.path.join(image_directory, 'a_recon_%08d' % (iterations + 1))
-        x_ab_path = os.path.join(image_directory, 'ab_%08d' % (iterations + 1))
-        x_b_recon_path = os.path.join(image_directory, 'b_recon_%08d' % (iterations + 1))
-        x_ba_path = os.path.join(image_directory, 'ba_%08d' % (iterations + 1))
-        for path in (x_a_recon_path, x_ab_path, x_b_recon_path, x_ba_path,):
-            os.makedirs(path, exist_ok=True)
-        
-        with torch.no_grad():
-            self.eval()
-            rng = np.random.RandomState(1)
-            for i, (x_a, y_a) in enumerate(d_a):
-                c_a, s_a_fake = self.gen_a.encode(x_a.unsqueeze(0).cuda())
-                x_a_recon = self.gen_a.decode(c_a, s_a_fake)
-                vutils.save_image(x_a_recon, os.path.join(x_a_recon_path, '%05d.jpg' % i))
-                s_b = Variable(torch.tensor(rng.randn(self.style_dim, 1, 1), dtype=torch.float32).cuda())
-                x_ab = self.gen_b.decode(c_a, s_b.unsqueeze(0))
-                vutils.save_image(x_ab, os.path.join(x_ab_path, '%05d.jpg' % i))
-
-            for i, (x_b, y_b) in enumerate(d_b):
-                c_b, s_b_fake = self.gen_b.encode(x_b.unsqueeze(0).cuda())
-                x_b_recon = self.gen_b.decode(c_b, s_b_fake)
-                vutils.save_image(x_b_recon, os.path.join(x_b_recon_path, '%05d.jpg' % i))
-                s_a = Variable(torch.tensor(rng.randn(self.style_dim, 1, 1), dtype=torch.float32).cuda())
-                x_ba = self.gen_a.decode(c_b, s_a.unsqueeze(0))
-                vutils.save_image(x_ba, os.path.join(x_ba_path, '%05d.jpg' % i))
-
-            self.train()
-        return x_a_recon_path, x_ab_path, x_b_recon_path, x_ba_path
+    def translate_datasets(self, d_a, d_b, batch_size=32):
+        self.eval()
+        for batch in translate_datasets(self.gen_a, self.gen_b, d_a, d_b, self.style_dim, batch_size):
+            yield batch
+        self.train()
 
     def sample(self, x_a, x_b):
         self.eval()
-        s_a1 = Variable(self.s_a)
-        s_b1 = Variable(self.s_b)
-        s_a2 = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1).cuda())
-        s_b2 = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1).cuda())
-        x_a_recon, x_b_recon, x_ba1, x_ba2, x_ab1, x_ab2 = [], [], [], [], [], []
-        for i in range(x_a.size(0)):
-            c_a, s_a_fake = self.gen_a.encode(x_a[i].unsqueeze(0))
-            c_b, s_b_fake = self.gen_b.encode(x_b[i].unsqueeze(0))
-            x_a_recon.append(self.gen_a.decode(c_a, s_a_fake))
-            x_b_recon.append(self.gen_b.decode(c_b, s_b_fake))
-            x_ba1.append(self.gen_a.decode(c_b, s_a1[i].unsqueeze(0)))
-            x_ba2.append(self.gen_a.decode(c_b, s_a2[i].unsqueeze(0)))
-            x_ab1.append(self.gen_b.decode(c_a, s_b1[i].unsqueeze(0)))
-            x_ab2.append(self.gen_b.decode(c_a, s_b2[i].unsqueeze(0)))
-        x_a_recon, x_b_recon = torch.cat(x_a_recon), torch.cat(x_b_recon)
-        x_ba1, x_ba2 = torch.cat(x_ba1), torch.cat(x_ba2)
-        x_ab1, x_ab2 = torch.cat(x_ab1), torch.cat(x_ab2)
+        n = x_a.size(0)
+        s_a1 = Variable(self.s_a[:n])
+        s_b1 = Variable(self.s_b[:n])
+        s_a2 = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1, device=x_a.device))
+        s_b2 = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1, device=x_b.device))
+        # all display images go through the networks as one batch
+        c_a, s_a_fake = self.gen_a.encode(x_a)
+        c_b, s_b_fake = self.gen_b.encode(x_b)
+        x_a_recon = self.gen_a.decode(c_a, s_a_fake)
+        x_b_recon = self.gen_b.decode(c_b, s_b_fake)
+        # both style codes of a content code are decoded in one pass
+        x_ba1, x_ba2 = self.gen_a.decode_many(c_b, [s_a1, s_a2])
+        x_ab1, x_ab2 = self.gen_b.decode_many(c_a, [s_b1, s_b2])
         self.train()
         return x_a, x_a_recon, x_ab1, x_ab2, x_b, x_b_recon, x_ba1, x_ba2
 
     def dis_update(self, x_a, x_b, hyperparameters):
+        s_a = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1, device=x_a.device))
+        s_b = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1, device=x_b.device))
+        with torch.no_grad(), self.autocast():
+            # encode (the style codes are not needed)
+            c_a = self.gen_a.encode_content(x_a)
+            c_b = self.gen_b.encode_content(x_b)
+            # decode (cross domain)
+            x_ba = self.gen_a.decode(c_b, s_a)
+            x_ab = self.gen_b.decode(c_a, s_b)
+        self._dis_update(x_a, x_b, x_ba, x_ab, hyperparameters)
+
+    def _dis_update(self, x_a, x_b, x_ba, x_ab, hyperparameters):
+        # x_ba and x_ab (image batches or their pyramids) must not require grad
         self.dis_opt.zero_grad()
-        s_a = Variable(torch.randn(x_a.size(0), self.style_dim, 1, 1).cuda())
-        s_b = Variable(torch.randn(x_b.size(0), self.style_dim, 1, 1).cuda())
-        # encode
-        c_a, _ = self.gen_a.encode(x_a)
-        c_b, _ = self.gen_b.encode(x_b)
-        # decode (cross domain)
-        x_ba = self.gen_a.decode(c_b, s_a)
-        x_ab = self.gen_b.decode(c_a, s_b)
         # D loss
-        self.loss_dis_a = self.dis_a.calc_dis_loss(x_ba.detach(), x_a)
-        self.loss_dis_b = self.dis_b.calc_dis_loss(x_ab.detach(), x_b)
-        self.loss_dis_total = hyperparameters['gan_w'] * self.loss_dis_a + hyperparameters['gan_w'] * self.loss_dis_b
+        with self.autocast():
+            self.loss_dis_a = self.dis_a.calc_dis_loss(x_ba, x_a)
+            self.loss_dis_b = self.dis_b.calc_dis_loss(x_ab, x_b)
+            self.loss_dis_total = hyperparameters['gan_w'] * self.loss_dis_a + hyperparameters['gan_w'] * self.loss_dis_b
         self.loss_dis_total.backward()
+        if self.distributed:
+            all_reduce_gradients(self.dis_opt)
         self.dis_opt.step()
 
     def get_info(self):
@@ -235,17 +292,17 @@ class Trainer(nn.Module):
     def resume(self, checkpoint_dir, hyperparameters):
         # Load generators
         last_model_name = get_model_list(checkpoint_dir, "gen")
-        state_dict = torch.load(last_model_name)
+        state_dict = torch.load(last_model_name, map_location='cpu')
         self.gen_a.load_state_dict(state_dict['a'])
         self.gen_b.load_state_dict(state_dict['b'])
         iterations = int(last_model_name[-11:-3])
         # Load discriminators
         last_model_name = get_model_list(checkpoint_dir, "dis")
-        state_dict = torch.load(last_model_name)
+        state_dict = torch.load(last_model_name, map_location='cpu')
         self.dis_a.load_state_dict(state_dict['a'])
         self.dis_b.load_state_dict(state_dict['b'])
         # Load optimizers
-        state_dict = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'))
+        state_dict = torch.load(os.path.join(checkpoint_dir, 'optimizer.pt'), map_location='cpu')
         self.dis_opt.load_state_dict(state_dict['dis'])
         self.gen_opt.load_state_dict(state_dict['gen'])
         # Reinitilize schedulers
@@ -254,6 +311,13 @@ class Trainer(nn.Module):
         print('Resume from iteration %d' % iterations)
         return iterations
 
+    def get_gen_snapshot(self):
+        # copy of the generator weights on CPU, for evaluation outside of the training process
+        return {
+            'a': {k: v.detach().to('cpu', copy=True) for k, v in self.gen_a.state_dict().items()},
+            'b': {k: v.detach().to('cpu', copy=True) for k, v in self.gen_b.state_dict().items()},
+        }
+
     def save(self, snapshot_dir, iterations):
         # Save generators, discriminators, and optimizers
         gen_name = os.path.join(snapshot_dir, 'gen_%08d.pt' % (iterations + 1))
@@ -262,3 +326,26 @@ class Trainer(nn.Module):
         torch.save({'a': self.gen_a.state_dict(), 'b': self.gen_b.state_dict()}, gen_name)
         torch.save({'a': self.dis_a.state_dict(), 'b': self.dis_b.state_dict()}, dis_name)
         torch.save({'gen': self.gen_opt.state_dict(), 'dis': self.dis_opt.state_dict()}, opt_name)
+
+
+def translate_datasets(gen_a, gen_b, d_a, d_b, style_dim, batch_size=32):
+    # yield ('a', x_a_recon, x_ab) for every batch of d_a, then ('b', x_b_recon, x_ba) for d_b,
+    # the style codes always come from RandomState(1) so the results are comparable between runs
+    rng = np.random.RandomState(1)
+    device = next(gen_a.parameters()).device
+    for x_a, y_a in DataLoader(d_a, batch_size=batch_size):
+        with torch.no_grad():
+            c_a, s_a_fake = gen_a.encode(x_a.to(device))
+            x_a_recon = gen_a.decode(c_a, s_a_fake)
+            # same random stream as drawing one style code per image
+            s_b = torch.tensor(rng.randn(x_a.size(0), style_dim, 1, 1), dtype=torch.float32, device=device)
+            x_ab = gen_b.decode(c_a, s_b)
+        yield 'a', x_a_recon, x_ab
+
+    for x_b, y_b in DataLoader(d_b, batch_size=batch_size):
+        with torch.no_grad():
+            c_b, s_b_fake = gen_b.encode(x_b.to(device))
+            x_b_recon = gen_b.decode(c_b, s_b_fake)
+            s_a = torch.tensor(rng.randn(x_b.size(0), style_dim, 1, 1), dtype=torch.float32, device=device)
+            x_ba = gen_a.decode(c_b, s_a)
+        yield 'b', x_b_recon, x_ba
@@ -1,12 +1,20 @@
 """
 Modified from https://github.com/NVlabs/MUNIT/blob/master/utils.py
 """
+import collections
+import contextlib
+import functools
 import math
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.init as init
 import torchvision.utils as vutils
@@ -14,17 +22,28 @@ import yaml
 from torch.autograd import Variable
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
-from torch.utils.serialization import load_lua
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 
-from data import ImageFilelist, ImageFolder, ImageLabelFileInfo, WCDataset, WCPairDataset
+from data import (IdentityBalancedBatchSampler, ImageFilelist, ImageFolder, ImageLabelFileInfo, PackedImages, WCDataset,
+                  default_loader, draft_loader,
+                  WCPackedDataset, WCPairDataset, get_pack_path)
 
 # Methods
 # get_all_data_loaders      : primary data loader interface (load trainA, testA, trainB, testB)
 # get_data_loader_list      : list-based data loader
 # get_data_loader_folder    : folder-based data loader
+# get_loader                : the DataLoader factory shared by the data loaders
+# BatchAugment              : flip, crop and normalize uint8 training batches with tensor ops
+# Prefetcher                : move the next batches to the device on a background thread
 # get_config                : load yaml file
+# get_device                : torch device and cpu thread counts from the config
+# is_distributed            : whether this process is a data-parallel worker
+# broadcast_module          : copy rank 0's weights to every worker
+# all_reduce_gradients      : average the gradients of an optimizer over the workers
 # eformat                   :
+# ImageWriter               : save images on background threads
 # write_2images             : save output image
 # prepare_sub_folder        : create checkpoints and images folders for saving outputs
 # write_one_row_html        : write one row of the html file for output images
@@ -50,17 +69,27 @@ def get_all_data_loaders(conf):
     height = conf['crop_image_height']
     width = conf['crop_image_width']
     clear_mode = conf['clear_mode']
+    pack_root = conf.get('pack_root', None)
+    loader_options = conf.get('loader', None)
+    batch_augment = conf.get('batch_augment', False)
+    jpeg_draft = conf.get('jpeg_draft', False)
 
     train_loader_a = get_WCdata_loader(conf['data_root'], 'c', batch_size, True,
-                                       new_size_a, height, width, num_workers, True, clear_mode=clear_mode)
+                                       new_size_a, height, width, num_workers, True, clear_mode=clear_mode, pack_root=pack_root,
+                                       loader_options=loader_options, batch_augment=batch_augment, jpeg_draft=jpeg_draft)
     test_loader_a = get_WCdata_loader(conf['data_root'], 'c', batch_size, False,
-                                      new_size_a, height, width, num_workers, True, clear_mode=clear_mode)
+                                      new_size_a, height, width, num_workers, True, clear_mode=clear_mode, pack_root=pack_root,
+                                      loader_options=loader_options)
     train_loader_b = get_WCdata_loader(conf['data_root'], 'p', batch_size, True,
-                                       new_size_b, height, width, num_workers, True, clear_mode=clear_mode)
+                                       new_size_b, height, width, num_workers, True, clear_mode=clear_mode, pack_root=pack_root,
+                                       loader_options=loader_options, batch_augment=batch_augment, jpeg_draft=jpeg_draft)
     test_loader_b = get_WCdata_loader(conf['data_root'], 'p', batch_size, False,
-                                      new_size_b, height, width, num_workers, True, clear_mode=clear_mode)
+                                      new_size_b, height, width, num_workers, True, clear_mode=clear_mode, pack_root=pack_root,
+                                      loader_options=loader_options)
     combine_loader = get_combine_loader(conf['data_root'], batch_size, True, new_size_a,
-                                        height, width, num_workers, True, clear_mode=clear_mode)
+                                        height, width, num_workers, True, clear_mode=clear_mode, pack_root=pack_root,
+                                        pos_ratio=conf.get('pos_ratio', 0.5), loader_options=loader_options,
+                                        batch_augment=batch_augment, jpeg_draft=jpeg_draft)
     # if 'data_root' in conf:
     #     train_loader_a = get_data_loader_folder(os.path.join(conf['data_root'], 'trainA'), batch_size, True,
     #                                           new_size_a, height, width, num_workers, True)
@@ -91,74 +120,233 @@ def get_all_data_loaders(conf):
     return train_loader_a, train_loader_b, test_loader_a, test_loader_b, combine_loader
 
 
-def get_data_loader_list(root, file_list, batch_size, train, new_size=None,
-                           height=256, width=256, num_workers=4, crop=True):
+def get_image_loader(new_size=None, jpeg_draft=False):
+    # with jpeg_draft JPEGs are decoded at a reduced scale and resized to new_size already (see data.draft_loader),
+    # the test sets are always decoded in full so that FID is computed on the same images as before
+    if jpeg_draft and new_size is not None:
+        return functools.partial(draft_loader, new_size=new_size)
+    return default_loader
+
+
+def get_transform(train, new_size=None, height=256, width=256, crop=True, batch_augment=False):
+    if batch_augment:
+        # only the resize runs per image in the workers, BatchAugment does the rest on whole batches
+        transform_list = [transforms.Resize(new_size)] if new_size is not None else []
+        return transforms.Compose(transform_list + [pil_to_uint8])
     transform_list = [transforms.ToTensor(),
                       transforms.Normalize((0.5, 0.5, 0.5),
                                            (0.5, 0.5, 0.5))]
     transform_list = [transforms.RandomCrop((height, width))] + transform_list if crop else transform_list
     transform_list = [transforms.Resize(new_size)] + transform_list if new_size is not None else transform_list
     transform_list = [transforms.RandomHorizontalFlip()] + transform_list if train else transform_list
-    transform = transforms.Compose(transform_list)
+    return transforms.Compose(transform_list)
+
+
+def pil_to_uint8(img):
+    # (C, H, W) uint8 tensor of a PIL image, ToTensor without the conversion to float
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
+
+
+def uint8_collate(batch, min_size=None):
+    # default_collate, except that the uint8 images of pil_to_uint8 become an (images, sizes) pair:
+    # (N, C, H, W) images padded to the largest one and the (N, 2) height and width of every image.
+    # min_size: the (height, width) BatchAugment crops, checked here on the cpu so that the augment
+    # on the device does not wait for the check
+    elem = batch[0]
+    if torch.is_tensor(elem) and elem.dtype == torch.uint8 and elem.dim() == 3:
+        sizes = torch.tensor([img.shape[1:] for img in batch], dtype=torch.int64)
+        if min_size is not None:
+            assert bool((sizes >= sizes.new_tensor(min_size)).all()), 'images smaller than the crop size'
+        if bool((sizes == sizes[0]).all()):
+            return default_collate(batch), sizes
+        h, w = sizes.max(0)[0].tolist()
+        images = torch.zeros(len(batch), elem.size(0), h, w, dtype=torch.uint8)
+        for image, img in zip(images, batch):
+            image[:, :img.size(1), :img.size(2)] = img
+        return images, sizes
+    if isinstance(elem, (tuple, list)):
+        return type(elem)(uint8_collate(samples, min_size) for samples in zip(*batch))
+    return default_collate(batch)
+
+
+def get_uint8_collate(batch_augment, height, width, crop=True):
+    # the collate_fn of the loaders, uint8_collate with batch_augment
+    if not batch_augment:
+        return None
+    return functools.partial(uint8_collate, min_size=(height, width) if crop else None)
+
+
+class BatchAugment:
+    """
+    RandomHorizontalFlip, RandomCrop((height, width)), ToTensor and Normalize((0.5,)*3, (0.5,)*3) of
+    get_transform for the (images, sizes) uint8 batches of uint8_collate, on whatever device they are.
+    flips and crop offsets are drawn per sample with the same distributions as the PIL transforms.
+    the flip comes first there, cropping the flipped image at left is cropping the image at
+    w - left - width and flipping the crop
+    """
+    def __init__(self, height, width, crop=True, flip=True):
+        self.height = height
+        self.width = width
+        self.crop = crop
+        self.flip = flip
+
+    def __call__(self, batch):
+        images, sizes = batch
+        n, device = images.size(0), images.device
+        if self.crop:
+            height, width = self.height, self.width
+            # batches on the device were checked by the uint8_collate of their loader
+            if sizes.device.type == 'cpu':
+                assert bool((sizes >= sizes.new_tensor([height, width])).all()), 'images smaller than the crop size'
+            top = (torch.rand(n, device=device) * (sizes[:, 0] - height + 1)).long()
+            left = (torch.rand(n, device=device) * (sizes[:, 1] - width + 1)).long()
+        else:
+            height, width = images.size(2), images.size(3)
+            top = left = torch.zeros(n, dtype=torch.int64, device=device)
+        flip = torch.rand(n, device=device) < 0.5 if self.flip else torch.zeros(n, dtype=torch.bool, device=device)
+        return self.apply(images, sizes, top, left, flip, height, width)
+
+    @staticmethod
+    def apply(images, sizes, top, left, flip, height, width):
+        device = images.device
+        rows = top[:, None] + torch.arange(height, device=device)
+        cols = left[:, None] + torch.arange(width, device=device)
+        cols = torch.where(flip[:, None], sizes[:, 1:] - 1 - cols, cols)
+        # one gather over the flattened pixels for the whole batch
+        n, c = images.size(0), images.size(1)
+        idx = (rows[:, :, None] * images.size(3) + cols[:, None, :]).view(n, 1, -1).expand(-1, c, -1)
+        out = images.reshape(n, c, -1).gather(2, idx).view(n, c, height, width)
+        return out.float().mul_(2 / 255.).sub_(1)
+
+
+def get_batch_augment(conf):
+    # the BatchAugment of the training loaders, None unless batch_augment is set in the config
+    if not conf.get('batch_augment', False):
+        return None
+    return BatchAugment(conf['crop_image_height'], conf['crop_image_width'])
+
+
+def get_display_images(loader, display_size, augment=None):
+    images = [loader.dataset[i][0] for i in range(display_size)]
+    if augment is None:
+        return torch.stack(images)
+    return augment(uint8_collate(images))
+
+
+class InfiniteSampler(torch.utils.data.Sampler):
+    # repeats sampler (or batch sampler) forever and calls its set_epoch before every pass,
+    # so the DataLoader iterator and its workers live for the whole training
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # epoch of the first pass
+        self.epoch = epoch
+
+    def __iter__(self):
+        epoch = self.epoch
+        while True:
+            if hasattr(self.sampler, 'set_epoch'):
+                self.sampler.set_epoch(epoch)
+            for indices in self.sampler:
+                yield indices
+            epoch += 1
+
+
+def get_loader(dataset, batch_size, train, num_workers=4, batch_sampler=None, loader_options=None, collate_fn=None):
+    """
+    the DataLoader of every get_*_loader helper. training sets are shuffled (each data-parallel worker
+    reads its own DistributedSampler shard) and drop the last batch, unless batch_sampler is given.
+    loader_options (the `loader` block of the config):
+        persistent_workers: keep the worker processes between epochs
+        pin_memory: collate into page-locked memory for asynchronous copies to the gpu
+        prefetch_factor: batches loaded ahead by every worker
+        infinite: training sets only, iterate forever over epochs (see InfiniteSampler)
+    """
+    options = loader_options or {}
+    kwargs = {'num_workers': num_workers, 'pin_memory': options.get('pin_memory', False),
+              'collate_fn': collate_fn or default_collate}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = options.get('persistent_workers', False)
+        if options.get('prefetch_factor'):
+            kwargs['prefetch_factor'] = options['prefetch_factor']
+    infinite = train and options.get('infinite', False)
+    if batch_sampler is not None:
+        batch_sampler = InfiniteSampler(batch_sampler) if infinite else batch_sampler
+        return DataLoader(dataset=dataset, batch_sampler=batch_sampler, **kwargs)
+    if train:
+        sampler = DistributedSampler(dataset) if is_distributed() else torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    # with infinite the batches run over the epoch ends, only the very last one could be dropped
+    sampler = InfiniteSampler(sampler) if infinite else sampler
+    return DataLoader(dataset=dataset, batch_size=batch_size, sampler=sampler, drop_last=True, **kwargs)
+
+
+def get_data_loader_list(root, file_list, batch_size, train, new_size=None,
+                           height=256, width=256, num_workers=4, crop=True, loader_options=None,
+                           batch_augment=False):
+    batch_augment = batch_augment and train
+    transform = get_transform(train, new_size, height, width, crop, batch_augment)
     dataset = ImageFilelist(root, file_list, transform=transform)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
-    return loader
+    return get_loader(dataset, batch_size, train, num_workers, loader_options=loader_options,
+                      collate_fn=get_uint8_collate(batch_augment, height, width, crop))
 
 
 def get_data_loader_folder(input_folder, batch_size, train, new_size=None,
-                           height=256, width=256, num_workers=4, crop=True):
-    transform_list = [transforms.ToTensor(),
-                      transforms.Normalize((0.5, 0.5, 0.5),
-                                           (0.5, 0.5, 0.5))]
-    transform_list = [transforms.RandomCrop((height, width))] + transform_list if crop else transform_list
-    transform_list = [transforms.Resize(new_size)] + transform_list if new_size is not None else transform_list
-    transform_list = [transforms.RandomHorizontalFlip()] + transform_list if train else transform_list
-    transform = transforms.Compose(transform_list)
+                           height=256, width=256, num_workers=4, crop=True, loader_options=None,
+                           batch_augment=False):
+    batch_augment = batch_augment and train
+    transform = get_transform(train, new_size, height, width, crop, batch_augment)
     dataset = ImageFolder(input_folder, transform=transform)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
-    return loader
+    return get_loader(dataset, batch_size, train, num_workers, loader_options=loader_options,
+                      collate_fn=get_uint8_collate(batch_augment, height, width, crop))
 
 
 def get_data_loader_info(input_folder, batch_size, train, new_size=None,
-                           height=256, width=256, num_workers=4, crop=True):
-    transform_list = [transforms.ToTensor(),
-                      transforms.Normalize((0.5, 0.5, 0.5),
-                                           (0.5, 0.5, 0.5))]
-    transform_list = [transforms.RandomCrop((height, width))] + transform_list if crop else transform_list
-    transform_list = [transforms.Resize(new_size)] + transform_list if new_size is not None else transform_list
-    transform_list = [transforms.RandomHorizontalFlip()] + transform_list if train else transform_list
-    transform = transforms.Compose(transform_list)
+                           height=256, width=256, num_workers=4, crop=True, loader_options=None,
+                           batch_augment=False):
+    batch_augment = batch_augment and train
+    transform = get_transform(train, new_size, height, width, crop, batch_augment)
     dataset = ImageLabelFileInfo(input_folder, transform=transform)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
-    return loader
+    return get_loader(dataset, batch_size, train, num_workers, loader_options=loader_options,
+                      collate_fn=get_uint8_collate(batch_augment, height, width, crop))
 
 
 def get_WCdata_loader(dataset_path, data_type, batch_size, train, new_size=None,
-                      height=112, width=96, num_workers=4, crop=True, clear_mode=False):
-    transform_list = [transforms.ToTensor(),
-                      transforms.Normalize((0.5, 0.5, 0.5),
-                                           (0.5, 0.5, 0.5))]
-    transform_list = [transforms.RandomCrop((height, width))] + transform_list if crop else transform_list
-    transform_list = [transforms.Resize(new_size)] + transform_list if new_size is not None else transform_list
-    transform_list = [transforms.RandomHorizontalFlip()] + transform_list if train else transform_list
-    transform = transforms.Compose(transform_list)
-    dataset = WCDataset(dataset_path, train, data_type, clear_mode=clear_mode, transform=transform)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
-    return loader
+                      height=112, width=96, num_workers=4, crop=True, clear_mode=False, pack_root=None,
+                      loader_options=None, batch_augment=False, jpeg_draft=False):
+    # with batch_augment the training batches are uint8 (images, sizes) pairs for BatchAugment
+    batch_augment = batch_augment and train
+    transform = get_transform(train, new_size, height, width, crop, batch_augment)
+    if pack_root is not None:
+        # images are already decoded and resized by `python data.py --pack_root ...`
+        dataset = WCPackedDataset(get_pack_path(pack_root, train), data_type, clear_mode=clear_mode, transform=transform)
+        dataset.packed_images.check_new_size(new_size)
+    else:
+        dataset = WCDataset(dataset_path, train, data_type, clear_mode=clear_mode, transform=transform,
+                            loader=get_image_loader(new_size, jpeg_draft and train))
+    return get_loader(dataset, batch_size, train, num_workers, loader_options=loader_options,
+                      collate_fn=get_uint8_collate(batch_augment, height, width, crop))
 
 
 def get_combine_loader(dataset_path, batch_size, train, new_size=None,
-                      height=112, width=96, num_workers=4, crop=True, clear_mode=False):
-    transform_list = [transforms.ToTensor(),
-                      transforms.Normalize((0.5, 0.5, 0.5),
-                                           (0.5, 0.5, 0.5))]
-    transform_list = [transforms.RandomCrop((height, width))] + transform_list if crop else transform_list
-    transform_list = [transforms.Resize(new_size)] + transform_list if new_size is not None else transform_list
-    transform_list = [transforms.RandomHorizontalFlip()] + transform_list if train else transform_list
-    transform = transforms.Compose(transform_list)
-    dataset = WCPairDataset(dataset_path, clear_mode=clear_mode, transform=transform)
-    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=train, drop_last=True, num_workers=num_workers)
-    return loader
+                      height=112, width=96, num_workers=4, crop=True, clear_mode=False, pack_root=None, pos_ratio=0.5,
+                      loader_options=None, batch_augment=False, jpeg_draft=False):
+    batch_augment = batch_augment and train
+    transform = get_transform(train, new_size, height, width, crop, batch_augment)
+    if pack_root is not None:
+        dataset = WCPairDataset(dataset_path, clear_mode=clear_mode, transform=transform,
+                                loader=PackedImages(get_pack_path(pack_root, True)).check_new_size(new_size))
+    else:
+        dataset = WCPairDataset(dataset_path, clear_mode=clear_mode, transform=transform,
+                                loader=get_image_loader(new_size, jpeg_draft and train))
+    # pairs are drawn by the sampler, data-parallel workers each take their own shard of the anchors
+    num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if is_distributed() else (1, 0)
+    batch_sampler = IdentityBalancedBatchSampler(dataset, batch_size, pos_ratio, num_replicas=num_replicas, rank=rank)
+    return get_loader(dataset, batch_size, train, num_workers, batch_sampler, loader_options,
+                      get_uint8_collate(batch_augment, height, width, crop))
 
 
 def get_config(config):
@@ -166,6 +354,37 @@ def get_config(config):
         return yaml.load(stream)
 
 
+def get_device(config):
+    # device defaults to cuda, num_threads / num_interop_threads set torch's intra-op and
+    # inter-op thread pools, which is what matters when training on cpu
+    if config.get('num_threads'):
+        torch.set_num_threads(config['num_threads'])
+    if config.get('num_interop_threads'):
+        torch.set_num_interop_threads(config['num_interop_threads'])
+    return torch.device(config.get('device', 'cuda'))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def broadcast_module(module):
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def all_reduce_gradients(optimizer):
+    # one all-reduce over all gradients flattened together instead of one per parameter
+    grads = [p.grad for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for grad, synced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
 def eformat(f, prec):
     s = "%.*e"%(prec, f)
     mantissa, exp = s.split('e')
@@ -173,17 +392,121 @@ def eformat(f, prec):
     return "%se%d"%(mantissa, int(exp))
 
 
-def __write_images(image_outputs, display_image_num, file_name):
+class ImageWriter:
+    # encode and write images on a thread pool, so the caller only waits for the copy to CPU.
+    # at most max_pending writes are queued, beyond that save_image waits for the oldest one
+    def __init__(self, num_workers=4, max_pending=64):
+        self.executor = ThreadPoolExecutor(num_workers)
+        self.max_pending = max_pending
+        self.futures = collections.deque()
+
+    def save_image(self, tensor, filename, **kwargs):
+        # forget the finished writes in submission order, a failed one raises here
+        while self.futures and (self.futures[0].done() or len(self.futures) >= self.max_pending):
+            self.futures.popleft().result()
+        tensor = tensor.detach().cpu()
+        self.futures.append(self.executor.submit(vutils.save_image, tensor, filename, **kwargs))
+
+    def wait(self):
+        # block until every submitted image is on disk, raise the first error if any
+        futures, self.futures = self.futures, collections.deque()
+        wait_futures(futures)
+        for future in futures:
+            future.result()
+
+
+def to_device(batch, device, non_blocking=False):
+    # move the tensors of a (nested) tuple/list batch
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(x, device, non_blocking) for x in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (tuple, list)):
+        for x in batch:
+            _record_stream(x, stream)
+
+
+class Prefetcher:
+    # iterate batches on a background thread and move up to depth of them to device ahead of the consumer,
+    # so loading, collating and the host to device copy of the next batch overlap the current update.
+    # on cuda the copies run on a side stream (from pinned memory they are asynchronous) and the
+    # consumer's stream waits for them
+    _done = object()
+
+    def __init__(self, batches, device, depth=2):
+        self.device = torch.device(device)
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, batches):
+        cuda = self.device.type == 'cuda'
+        stream = torch.cuda.Stream(self.device) if cuda else None
+        try:
+            for batch in batches:
+                with torch.cuda.stream(stream) if cuda else contextlib.nullcontext():
+                    batch = to_device(batch, self.device, non_blocking=cuda)
+                    event = torch.cuda.Event() if cuda else None
+                    if cuda:
+                        event.record(stream)
+                if not self._put((batch, event, None)):
+                    return
+        except Exception as e:
+            self._put((None, None, e))
+            return
+        self._put((self._done, None, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, event, error = self.queue.get()
+        if error is not None:
+            raise error
+        if batch is self._done:
+            raise StopIteration
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the side stream allocated these tensors, keep them alive until the consumer's work is done
+            _record_stream(batch, stream)
+        return batch
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def __write_images(image_outputs, display_image_num, file_name, writer=None):
     image_outputs = [images.expand(-1, 3, -1, -1) for images in image_outputs] # expand gray-scale images to 3 channels
     image_tensor = torch.cat([images[:display_image_num] for images in image_outputs], 0)
     image_grid = vutils.make_grid(image_tensor.data, nrow=display_image_num, padding=0, normalize=True)
-    vutils.save_image(image_grid, file_name, nrow=1)
+    if writer is not None:
+        writer.save_image(image_grid, file_name, nrow=1)
+    else:
+        vutils.save_image(image_grid, file_name, nrow=1)
 
 
-def write_2images(image_outputs, display_image_num, image_directory, postfix):
+def write_2images(image_outputs, display_image_num, image_directory, postfix, writer=None):
     n = len(image_outputs)
-    __write_images(image_outputs[0:n//2], display_image_num, '%s/gen_a2b_%s.jpg' % (image_directory, postfix))
-    __write_images(image_outputs[n//2:n], display_image_num, '%s/gen_b2a_%s.jpg' % (image_directory, postfix))
+    __write_images(image_outputs[0:n//2], display_image_num, '%s/gen_a2b_%s.jpg' % (image_directory, postfix), writer)
+    __write_images(image_outputs[n//2:n], display_image_num, '%s/gen_b2a_%s.jpg' % (image_directory, postfix), writer)
 
 
 def prepare_sub_folder(output_directory):
@@ -293,6 +616,7 @@ def load_vgg16(model_dir):
     if not os.path.exists(os.path.join(model_dir, 'vgg16.weight')):
         if not os.path.exists(os.path.join(model_dir, 'vgg16.t7')):
             os.system('wget https://www.dropbox.com/s/76l3rt4kyi3s8x7/vgg16.t7?dl=1 -O ' + os.path.join(model_dir, 'vgg16.t7'))
+        from torch.utils.serialization import load_lua
         vgglua = load_lua(os.path.join(model_dir, 'vgg16.t7'))
         vgg = Vgg16()
         for (src, dst) in zip(vgglua.parameters()[0], vgg.parameters()):
@@ -314,15 +638,11 @@ def load_inception(model_path):
     return model
 
 def vgg_preprocess(batch):
-    tensortype = type(batch.data)
     (r, g, b) = torch.chunk(batch, 3, dim = 1)
     batch = torch.cat((b, g, r), dim = 1) # convert RGB to BGR
     batch = (batch + 1) * 255 * 0.5 # [-1, 1] -> [0, 255]
-    mean = tensortype(batch.data.size()).cuda()
-    mean[:, 0, :, :] = 103.939
-    mean[:, 1, :, :] = 116.779
-    mean[:, 2, :, :] = 123.680
-    batch = batch.sub(Variable(mean)) # subtract mean
+    mean = batch.new_tensor([103.939, 116.779, 123.680]).view(1, 3, 1, 1)
+    batch = batch.sub(mean) # subtract mean
     return batch
 
 downsample = nn.AvgPool2d(3, stride=2, padding=[1, 1], count_include_pad=False)
@@ -372,15 +692,18 @@ def weights_init(init_type='gaussian'):
 
 
 class Timer:
-    def __init__(self, msg):
+    def __init__(self, msg, verbose=True):
+        # verbose=False only times, e.g. on the data-parallel workers other than rank 0
         self.msg = msg
+        self.verbose = verbose
         self.start_time = None
 
     def __enter__(self):
         self.start_time = time.time()
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        print(self.msg % (time.time() - self.start_time))
+        if self.verbose:
+            print(self.msg % (time.time() - self.start_time))
 
 
 def pytorch03_to_pytorch04(state_dict_base, trainer_name):
@@ -1,8 +1,11 @@
 import os
+import queue
 import sys
 from argparse import ArgumentParser
 
 import numpy as np
+import torch
+from torch.nn.functional import adaptive_avg_pool2d
 
 submodule_path = os.path.abspath('./codes/3rdparty/')
 try:
@@ -24,23 +27,198 @@ def save_statistics(src, dst, cuda):
     np.savez(dst, mu=m, sigma=s)
 
 
+class StreamingStatistics(object):
+    # running mean and covariance of the activations, same as np.mean and np.cov(rowvar=False)
+    def __init__(self, dims=dims):
+        self.n = 0
+        self.sum = np.zeros(dims, dtype=np.float64)
+        self.sum_outer = np.zeros((dims, dims), dtype=np.float64)
+
+    def update(self, act):
+        act = act.astype(np.float64)
+        self.n += act.shape[0]
+        self.sum += act.sum(axis=0)
+        self.sum_outer += act.T.dot(act)
+
+    def get(self):
+        mu = self.sum / self.n
+        sigma = (self.sum_outer - self.n * np.outer(mu, mu)) / (self.n - 1)
+        return mu, sigma
+
+
+class FIDEngine(object):
+    """
+    InceptionV3 and the reference statistics stay loaded for the whole run, the generated
+    images go from the generator straight into the inception activations.
+    """
+    def __init__(self, cuda, dims=dims):
+        block_idx = fid_score.InceptionV3.BLOCK_INDEX_BY_DIM[dims]
+        self.model = fid_score.InceptionV3([block_idx])
+        if cuda:
+            self.model = self.model.cuda()
+        self.model.eval()
+        self.cuda = cuda
+        self.dims = dims
+        self.reference = {}
+
+    def load_statistics(self, path):
+        if path not in self.reference:
+            with np.load(path) as f:
+                self.reference[path] = f['mu'][:], f['sigma'][:]
+        return self.reference[path]
+
+    def get_activations(self, images):
+        # images are generator outputs, convert them like vutils.save_image did when
+        # the images were written to disk: clamp to [0, 1] and quantize to 8 bits
+        images = (images.detach() * 255 + 0.5).clamp(0, 255).floor() / 255
+        images = images.cuda() if self.cuda else images.cpu()
+        with torch.no_grad():
+            pred = self.model(images)[0]
+        if pred.shape[2] != 1 or pred.shape[3] != 1:
+            pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+        return pred.cpu().numpy().reshape(pred.size(0), -1)
+
+    def calculate_fids(self, batches, afid_path, bfid_path):
+        stats = {name: StreamingStatistics(self.dims) for name in ('a_recon', 'ab', 'b_recon', 'ba',)}
+        for domain, x_recon, x_trans in batches:
+            recon_name, trans_name = ('a_recon', 'ab') if domain == 'a' else ('b_recon', 'ba')
+            stats[recon_name].update(self.get_activations(x_recon))
+            stats[trans_name].update(self.get_activations(x_trans))
+
+        reference = {'a': self.load_statistics(afid_path), 'b': self.load_statistics(bfid_path)}
+        fids = {}
+        for name, reference_domain in (('a_recon', 'a'), ('ab', 'b'), ('b_recon', 'b'), ('ba', 'a'),):
+            mu, sigma = stats[name].get()
+            fids[name + '_fid'] = fid_score.calculate_frechet_distance(mu, sigma, *reference[reference_domain])
+        return fids
+
+
+def eval_worker(config, cuda, in_queue, out_queue):
+    # runs in its own process, see AsyncEvaluator. the final None is sent even if something raises,
+    # the traceback is printed by the process
+    try:
+        from networks import AdaINGen
+        from trainer import translate_datasets
+        from utils import get_all_data_loaders
+
+        engine = FIDEngine(cuda)
+        _, _, test_loader_a, test_loader_b, _ = get_all_data_loaders(config)
+        gen_a = AdaINGen(config['input_dim_a'], config['gen'], name='gen_a')
+        gen_b = AdaINGen(config['input_dim_b'], config['gen'], name='gen_b')
+        if cuda:
+            gen_a, gen_b = gen_a.cuda(), gen_b.cuda()
+        gen_a.eval()
+        gen_b.eval()
+
+        while True:
+            snapshot = in_queue.get()
+            if snapshot is None:
+                break
+            gen_a.load_state_dict(snapshot['a'])
+            gen_b.load_state_dict(snapshot['b'])
+            batches = translate_datasets(gen_a, gen_b, test_loader_a.dataset, test_loader_b.dataset,
+                                         config['gen']['style_dim'])
+            fids = engine.calculate_fids(batches, config['afid_path'], config['bfid_path'])
+            out_queue.put((snapshot['iterations'], fids))
+    finally:
+        out_queue.put(None)
+
+
+class AsyncEvaluator(object):
+    """
+    Computes the fids of generator snapshots in another process, so training never waits for them.
+    At most max_pending snapshots wait in the queue, when it is full the oldest waiting snapshot
+    is dropped in favour of the new one.
+    """
+    def __init__(self, config, cuda, max_pending=1):
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.in_queue = ctx.Queue(max_pending)
+        self.out_queue = ctx.Queue()
+        self.process = ctx.Process(target=eval_worker, args=(config, cuda, self.in_queue, self.out_queue))
+        self.process.daemon = True
+        self.process.start()
+        self.finished = False
+
+    def submit(self, snapshot):
+        try:
+            self.in_queue.put_nowait(snapshot)
+        except queue.Full:
+            try:
+                stale = self.in_queue.get(timeout=1)
+                print('evaluation is behind, drop the snapshot of iteration %d' % (stale['iterations'] + 1))
+            except queue.Empty:
+                pass    # the worker took it in the meantime
+            self.in_queue.put(snapshot)
+
+    def poll(self):
+        # [(iterations, fids), ...] finished since the last call
+        results = []
+        while not self.finished:
+            try:
+                result = self.out_queue.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                print('fid evaluation process stopped early, see its error above')
+                self.finished = True
+            else:
+                results.append(result)
+        return results
+
+    def close(self, timeout=1):
+        # wait for the waiting snapshots and return all the results not polled yet.
+        # the queues are polled every timeout seconds so that a dead worker can not hang training
+        while not self.finished and self.process.is_alive():
+            try:
+                self.in_queue.put(None, timeout=timeout)
+                break
+            except queue.Full:
+                pass
+        results = []
+        while not self.finished:
+            try:
+                result = self.out_queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                print('fid evaluation process died without finishing')
+                break
+            if result is None:
+                self.finished = True
+            else:
+                results.append(result)
+        self.process.join()
+        return results
+
+
+def train_with_async_fid(args, train_main_func):
+    from utils import get_config
+
+    evaluator = AsyncEvaluator(get_config(args.config), args.gpu != '')
+    train_main = train_main_func(args, yield_mode=True, async_eval=True)
+    results = None
+
+    while True:
+        try:
+            snapshot = train_main.send(results)
+            if snapshot is None:
+                results = evaluator.close()
+            else:
+                evaluator.submit(snapshot)
+                results = evaluator.poll()
+        except StopIteration:
+            break
+
+
 def train_with_fid(args, train_main_func):
+    engine = FIDEngine(args.gpu != '')
     train_main = train_main_func(args, yield_mode=True)
     fids = None
 
     while True:
         try:
-            paths = train_main.send(fids)
-            fids = {
-                'a_recon_fid': fid_score.calculate_fid_given_paths([paths[4], paths[0]],
-                                                                   batch_size, args.gpu != '', dims),
-                'ab_fid': fid_score.calculate_fid_given_paths([paths[5], paths[1]],
-                                                              batch_size, args.gpu != '', dims),
-                'b_recon_fid': fid_score.calculate_fid_given_paths([paths[5], paths[2]],
-                                                                   batch_size, args.gpu != '', dims),
-                'ba_fid': fid_score.calculate_fid_given_paths([paths[4], paths[3]],
-                                                              batch_size, args.gpu != '', dims)
-            }
+            batches, afid_path, bfid_path = train_main.send(fids)
+            fids = engine.calculate_fids(batches, afid_path, bfid_path)
         except StopIteration:
             break
 
@@ -61,6 +239,8 @@ if __name__ == '__main__':
     parser.add_argument('--config', type=str, default='configs/init.yaml', help='Path to the config file.')
     parser.add_argument('--output_path', type=str, default='.', help="outputs path")
     parser.add_argument("--resume", action="store_true")
+    parser.add_argument('--async_fid', action='store_true',
+                        help='compute fid in another process while training goes on')
     # parser.add_argument('--trainer', type=str, default='MUNIT', help="MUNIT|UNIT")s
 
     args = parser.parse_args()
@@ -78,4 +258,7 @@ if __name__ == '__main__':
                 'SATNet',
             ))
             from train import main as train_main_func
-        train_with_fid(args, train_main_func)
\ No newline at end of file
+        if args.async_fid:
+            train_with_async_fid(args, train_main_func)
+        else:
+            train_with_fid(args, train_main_func)
\ No newline at end of file
@@ -1,10 +1,11 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 
 from .utils import tqdm
-from ...sphereface.matlab_cp2tform import get_similarity_transform_for_cv2
+from ...sphereface.face_align import align_faces, transform_points
 
 # 这里注意x代表的是横轴，y代表的是纵轴
 imgSize = np.array([128, 128])
@@ -74,6 +75,11 @@ def warp_img(img, landmark, image_type):
 
 
 def alignment(src_img, src_landmark, resize_factor=2):
+    face_imgs, dst_landmarks = alignments([src_img], [src_landmark], resize_factor)
+    return face_imgs[0], dst_landmarks[0]
+
+
+def alignments(src_imgs, src_landmarks, resize_factor=2, pool=None):
     offset = 2
     ref_pts = [
         [30.2946+offset, 51.6963+offset],
@@ -83,28 +89,17 @@ def alignment(src_img, src_landmark, resize_factor=2):
         [62.7299+offset, 92.2041+offset],
     ]
     crop_size = (96+offset*2, 112+offset*2)
-    src_pts = get_img5point(src_landmark)
-    src_pts = np.array(src_pts).reshape(5,2)
+    src_pts = np.array([get_img5point(src_landmark) for src_landmark in src_landmarks])
 
     s = np.array(src_pts).astype(np.float32)
     r = np.array(ref_pts).astype(np.float32) * resize_factor
     crop_size = (crop_size[0]*resize_factor, crop_size[1]*resize_factor)
 
-    tfm = get_similarity_transform_for_cv2(s, r)
-    face_img = cv2.warpAffine(src_img, tfm, crop_size)
+    face_imgs, tfms = align_faces(src_imgs, s, r, crop_size, pool=pool)
 
-    dst_landmark = np.array(src_landmark)
-    dst_landmark = np.concatenate((
-        dst_landmark,
-        np.ones((dst_landmark.shape[0], 1))
-    ), axis=1)
-    tfm = np.concatenate((
-        tfm,
-        np.array(((0, 0, 1),)),
-    ), axis=0)
-    dst_landmark = np.dot(dst_landmark, tfm.T)[:, :2]
-    dst_landmark = [tuple(x) for x in dst_landmark]
-    return face_img, dst_landmark
+    dst_landmarks = transform_points(src_landmarks, tfms)
+    dst_landmarks = [[tuple(x) for x in dst_landmark] for dst_landmark in dst_landmarks]
+    return face_imgs, dst_landmarks
 
 
 def generate_dataset_face_frontalization():
@@ -120,12 +115,7 @@ def generate_dataset_face_frontalization():
     new_images_dir = os.path.join(new_dataset_dirs[0], config.WC_original_images_dir_name)
     new_landmarks_dir = os.path.join(new_dataset_dirs[0], config.WC_landmarks_dir_name)
 
-    # face_frontalization
-    for people_name, image_type, image_name, landmark in tqdm(dataset_iterator(config.WC_original_dataset_name)):
-        im_str = get_image(config.WC_original_dataset_name, people_name, image_name, show_landmark=0)
-        im = im_str_to_np(im_str)
-        im, landmark = alignment(im, landmark)
-
+    def save(people_name, image_name, im, landmark):
         people_name = people_name.replace('_', ' ')
         file_dir = os.path.join(new_images_dir, people_name)
         os.makedirs(file_dir, exist_ok=True)
@@ -140,6 +130,28 @@ def generate_dataset_face_frontalization():
             for ld in landmark:
                 file.write('%f %f\n' % ld)
 
+    def load(people_name, image_name):
+        im_str = get_image(config.WC_original_dataset_name, people_name, image_name, show_landmark=0)
+        return im_str_to_np(im_str)
+
+    def flush(chunk):
+        people_names, image_names, landmarks = zip(*chunk)
+        ims = list(pool.map(load, people_names, image_names))
+        ims, landmarks = alignments(ims, landmarks, pool=pool)
+        list(pool.map(save, people_names, image_names, ims, landmarks))
+
+    # face_frontalization, chunk_size images are decoded, aligned and written together
+    chunk_size = 256
+    chunk = []
+    with ThreadPoolExecutor(8) as pool:
+        for people_name, image_type, image_name, landmark in tqdm(dataset_iterator(config.WC_original_dataset_name)):
+            chunk.append((people_name, image_name, landmark))
+            if len(chunk) == chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+
 
 if __name__ == '__main__':
     # from . import config
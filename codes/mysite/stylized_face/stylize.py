@@ -10,16 +10,16 @@ from torchvision import utils as vutils
 import dlib
 
 try:
-    from ...SATNet.data import default_loader
-    from ...SATNet.networks import AdaINGen
-    from ...sphereface.matlab_cp2tform import get_similarity_transform_for_cv2
+    from ...SATNet.data import draft_loader
+    from ...SATNet.networks import AdaINGen, fold_spectral_norm
+    from ...sphereface.face_align import align_faces
 except (ImportError, ValueError,):
     import sys
     sys.path.append(os.path.join(os.path.abspath('./codes'), 'SATNet'))
     sys.path.append(os.path.join(os.path.abspath('./codes'), 'sphereface'))
-    from data import default_loader
-    from networks import AdaINGen
-    from matlab_cp2tform import get_similarity_transform_for_cv2
+    from data import draft_loader
+    from networks import AdaINGen, fold_spectral_norm
+    from face_align import align_faces
 
 predictor_path = 'support_material/shape_predictor_68_face_landmarks.dat'
 detector = dlib.get_frontal_face_detector()
@@ -40,6 +40,9 @@ gen_a = AdaINGen(3, config).cuda().eval()
 gen_b = AdaINGen(3, config).cuda().eval()
 gen_a.load_state_dict(torch.load(model_path)['a'])
 gen_b.load_state_dict(torch.load(model_path)['b'])
+# inference only, the spectral normalized self-attention convs become plain convs
+fold_spectral_norm(gen_a)
+fold_spectral_norm(gen_b)
 
 
 transform_list = [transforms.ToTensor(),
@@ -96,8 +99,7 @@ def alignment(src_img_path, resize_factor=2):
     r = np.array(ref_pts).astype(np.float32) * resize_factor
     crop_size = (crop_size[0]*resize_factor, crop_size[1]*resize_factor)
 
-    tfm = get_similarity_transform_for_cv2(s, r)
-    face_img = cv2.warpAffine(cv2.imread(src_img_path), tfm, crop_size)
+    face_img = align_faces([cv2.imread(src_img_path)], s[None], r, crop_size)[0][0]
 
     dst_name = os.path.splitext(src_img_path)
     dst_img = dst_name[0]+'_alige'+dst_name[1]
@@ -107,18 +109,26 @@ def alignment(src_img_path, resize_factor=2):
 
 
 def stylize(img_path, seed=1):
-    img = transform(default_loader(img_path)).unsqueeze(0).cuda()
-    
-    rng = np.random.RandomState(seed)
-    s = torch.tensor(rng.randn(1, config['style_dim'], 1, 1), dtype=torch.float32).cuda()
+    return stylize_many(img_path, [seed])[0]
+
+
+def stylize_many(img_path, seeds):
+    # one variant per seed, the content code is computed once and all styles are decoded as one batch
+    img = transform(draft_loader(img_path, 200)).unsqueeze(0).cuda()
+
+    s = [torch.tensor(np.random.RandomState(seed).randn(1, config['style_dim'], 1, 1), dtype=torch.float32)
+         for seed in seeds]
     with torch.no_grad():
         c = gen_b.enc_content(img)
-        img = gen_a.decode(c, s)
+        imgs = gen_a.decode_many(c, torch.stack(s).cuda())
 
     img_name = os.path.splitext(img_path)
-    out_path = img_name[0]+'_s%05d'%seed+img_name[1]
-    vutils.save_image(img, out_path)
-    return out_path
+    out_paths = []
+    for seed, img in zip(seeds, imgs):
+        out_path = img_name[0]+'_s%05d'%seed+img_name[1]
+        vutils.save_image(img, out_path)
+        out_paths.append(out_path)
+    return out_paths
 
 
 if __name__ == "__main__":
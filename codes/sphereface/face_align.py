@@ -0,0 +1,113 @@
+'''
+batched version of matlab_cp2tform.get_similarity_transform_for_cv2: the
+least-squares similarity transform of N landmark sets is solved in closed form
+with numpy, and the cv2.warpAffine calls run on a thread pool.
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def find_nonreflective_similarities(uv, xy):
+    '''
+    uv: (N, K, 2) source points, xy: (N, K, 2) destination points.
+    returns trans, trans_inv as (N, 3, 3), [x, y, 1] = [u, v, 1] * trans,
+    the same as matlab_cp2tform.findNonreflectiveSimilarity for every set.
+    '''
+    # minimizing |[x y 1 0; y -x 0 1] * [sc ss tx ty]' - [u; v]| on centered points
+    # separates the translation from the rotation and scale
+    xy_mean = xy.mean(axis=1, keepdims=True)
+    uv_mean = uv.mean(axis=1, keepdims=True)
+    x, y = np.moveaxis(xy - xy_mean, -1, 0)
+    u, v = np.moveaxis(uv - uv_mean, -1, 0)
+    denom = np.sum(x*x + y*y, axis=1)
+    if np.any(denom <= 1e-12):
+        raise Exception('cp2tform:twoUniquePointsReq')
+    sc = np.sum(x*u + y*v, axis=1) / denom
+    ss = np.sum(y*u - x*v, axis=1) / denom
+    tx = uv_mean[:, 0, 0] - sc*xy_mean[:, 0, 0] - ss*xy_mean[:, 0, 1]
+    ty = uv_mean[:, 0, 1] + ss*xy_mean[:, 0, 0] - sc*xy_mean[:, 0, 1]
+
+    n = len(uv)
+    trans_inv = np.zeros((n, 3, 3))
+    trans_inv[:, 0, 0] = sc
+    trans_inv[:, 0, 1] = -ss
+    trans_inv[:, 1, 0] = ss
+    trans_inv[:, 1, 1] = sc
+    trans_inv[:, 2, 0] = tx
+    trans_inv[:, 2, 1] = ty
+    trans_inv[:, 2, 2] = 1
+
+    # inverse of [A 0; t 1] is [A^-1 0; -t*A^-1 1], A^-1 = A' / (sc^2 + ss^2)
+    trans = np.zeros((n, 3, 3))
+    trans[:, :2, :2] = np.swapaxes(trans_inv[:, :2, :2], 1, 2) / (sc*sc + ss*ss)[:, None, None]
+    trans[:, 2, :2] = -np.einsum('ni,nij->nj', trans_inv[:, 2, :2], trans[:, :2, :2])
+    trans[:, 2, 2] = 1
+    return trans, trans_inv
+
+
+def tformfwd(trans, uv):
+    return np.einsum('nki,nij->nkj', uv, trans[:, :2, :2]) + trans[:, None, 2, :2]
+
+
+def find_similarities(uv, xy):
+    '''
+    same as matlab_cp2tform.findSimilarity for every set.
+    '''
+    trans1, trans1_inv = find_nonreflective_similarities(uv, xy)
+
+    xyR = xy.copy()
+    xyR[:, :, 0] *= -1
+    trans2r, _ = find_nonreflective_similarities(uv, xyR)
+    trans2 = trans2r * np.array([-1, 1, 1])
+
+    # findSimilarity reflects xy in place before measuring both fits, so the
+    # norms are taken against the reflected points as well
+    norm1 = np.linalg.norm((tformfwd(trans1, uv) - xyR).reshape(len(uv), -1), axis=1)
+    norm2 = np.linalg.norm((tformfwd(trans2, uv) - xyR).reshape(len(uv), -1), axis=1)
+
+    use1 = (norm1 <= norm2)[:, None, None]
+    trans = np.where(use1, trans1, trans2)
+    trans_inv = np.where(use1, trans1_inv, np.linalg.inv(trans2))
+    return trans, trans_inv
+
+
+def get_similarity_transforms_for_cv2(src_pts, dst_pts, reflective=True):
+    '''
+    src_pts: (N, K, 2), dst_pts: (K, 2) shared by all sets or (N, K, 2).
+    returns (N, 2, 3) matrices for cv2.warpAffine.
+    '''
+    src_pts = np.asarray(src_pts, dtype=np.float64)
+    dst_pts = np.broadcast_to(np.asarray(dst_pts, dtype=np.float64), src_pts.shape)
+    if reflective:
+        trans, _ = find_similarities(src_pts, dst_pts)
+    else:
+        trans, _ = find_nonreflective_similarities(src_pts, dst_pts)
+    return np.swapaxes(trans[:, :, :2], 1, 2)
+
+
+def transform_points(pts, tfms):
+    '''
+    apply (N, 2, 3) cv2 matrices to (N, K, 2) points.
+    '''
+    pts = np.asarray(pts, dtype=np.float64)
+    return np.einsum('nkj,nij->nki', pts, tfms[:, :, :2]) + tfms[:, None, :, 2]
+
+
+def warp_affines(imgs, tfms, crop_size, pool=None, num_workers=8):
+    if pool is None and len(imgs) == 1:
+        return [cv2.warpAffine(imgs[0], tfms[0], crop_size)]
+    if pool is None:
+        with ThreadPoolExecutor(num_workers) as pool:
+            return warp_affines(imgs, tfms, crop_size, pool)
+    return list(pool.map(lambda args: cv2.warpAffine(args[0], args[1], crop_size), zip(imgs, tfms)))
+
+
+def align_faces(imgs, src_pts, ref_pts, crop_size, reflective=True, pool=None, num_workers=8):
+    '''
+    warp every image so that its five points land on ref_pts.
+    returns the aligned images and the (N, 2, 3) transforms.
+    '''
+    tfms = get_similarity_transforms_for_cv2(src_pts, ref_pts, reflective)
+    return warp_affines(imgs, tfms, crop_size, pool, num_workers), tfms
@@ -4,12 +4,14 @@ copied and modified from: https://github.com/clcarwin/sphereface_pytorch/blob/ma
 from __future__ import print_function
 
 import argparse
-import bisect
 import datetime
+import hashlib
+import json
 import os
-import pickle
 import random
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import cv2
 import numpy as np
@@ -19,7 +21,7 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import Variable
 
-from matlab_cp2tform import get_similarity_transform_for_cv2
+from face_align import align_faces
 from net_sphere import sphere20a
 
 torch.backends.cudnn.bencmark = True
@@ -52,87 +54,78 @@ def load_landmark(file_path):
     ])
 
 
+REF_PTS = [
+    [30.2946, 51.6963],
+    [65.5318, 51.5014],
+    [48.0252, 71.7366],
+    [33.5493, 92.3655],
+    [62.7299, 92.2041],
+]
+CROP_SIZE = (96, 112)
+
+
 def alignment(src_img,src_pts):
-    ref_pts = [
-        [30.2946, 51.6963],
-        [65.5318, 51.5014],
-        [48.0252, 71.7366],
-        [33.5493, 92.3655],
-        [62.7299, 92.2041],
-    ]
-    crop_size = (96, 112)
-    src_pts = np.array(src_pts).reshape(5,2)
+    return alignments([src_img], [src_pts])[0]
 
-    s = np.array(src_pts).astype(np.float32)
-    r = np.array(ref_pts).astype(np.float32)
 
-    tfm = get_similarity_transform_for_cv2(s, r)
-    face_img = cv2.warpAffine(src_img, tfm, crop_size)
-    return face_img
+def alignments(src_imgs, src_pts, pool=None):
+    s = np.array(src_pts).astype(np.float32).reshape(-1, 5, 2)
+    r = np.array(REF_PTS).astype(np.float32)
+    face_imgs, _ = align_faces(src_imgs, s, r, CROP_SIZE, pool=pool)
+    return face_imgs
 
 
 def KFold(folds_length):
+    # boolean masks over the predicts, fold i is tested on its own contiguous range
     folds = []
     n = sum(folds_length)
-    n_folds = len(folds_length)
-    l, r = 0, 0
-    base = list(range(n))
-    for i in range(n_folds):
-        r += folds_length[i]
-        test = base[l : r]
-        train = list(set(base)-set(test))
-        folds.append([train,test])
-        l += folds_length[i]
+    bounds = np.cumsum([0] + list(folds_length))
+    for l, r in zip(bounds[:-1], bounds[1:]):
+        test = np.zeros(n, dtype=bool)
+        test[l:r] = True
+        folds.append([~test, test])
     return folds
 
 
+def split_predicts(predicts):
+    scores = np.asarray(predicts[:, 0], dtype=np.float64)
+    same = np.asarray(predicts[:, 1], dtype=np.float64).astype(int) == 1
+    return np.sort(scores[same]), np.sort(scores[~same])
+
+
+def eval_accs(thresholds, predicts):
+    # a pair is predicted same if its score > threshold, so with sorted scores
+    # the correct predictions for every threshold are two searchsorted counts
+    pos_scores, neg_scores = split_predicts(predicts)
+    pos_correct = len(pos_scores) - np.searchsorted(pos_scores, thresholds, side='right')
+    neg_correct = np.searchsorted(neg_scores, thresholds, side='right')
+    return 1.0*(pos_correct+neg_correct)/len(predicts)
+
+
 def eval_acc(threshold, diff):
-    y_true = []
-    y_predict = []
-    for d in diff:
-        same = 1 if float(d[0]) > threshold else 0
-        y_predict.append(same)
-        y_true.append(int(d[1]))
-    y_true = np.array(y_true)
-    y_predict = np.array(y_predict)
-    accuracy = 1.0*np.count_nonzero(y_true==y_predict)/len(y_true)
-    return accuracy
+    return eval_accs(np.array([threshold]), diff)[0]
 
 
 def find_best_threshold(thresholds, predicts):
-    best_threshold = best_acc = 0
-    for threshold in thresholds:
-        accuracy = eval_acc(threshold, predicts)
-        if accuracy >= best_acc:
-            best_acc = accuracy
-            best_threshold = threshold
-    return best_threshold
+    # the last threshold reaching the best accuracy wins
+    accuracy = eval_accs(thresholds, predicts)
+    return thresholds[len(thresholds)-1-np.argmax(accuracy[::-1])]
 
 
 def calc_roc(predicts):
-    def get_tar(thd, pos_predicts):
-        return 1 - bisect.bisect_left(pos_predicts, thd) / len(pos_predicts)
-    pos_predicts, neg_predicts = [], []
-    for predict in predicts:
-        if int(predict[1]) == 1:
-            pos_predicts.append(float(predict[0]))
-        else:
-            neg_predicts.append(float(predict[0]))
-    pos_predicts.sort()
-    neg_predicts.sort()
+    pos_predicts, neg_predicts = split_predicts(predicts)
+
+    def get_tar(thd):
+        return 1 - np.searchsorted(pos_predicts, thd, side='left') / len(pos_predicts)
 
     far3_idx = int(len(neg_predicts)-1-len(neg_predicts)*1e-3)
-    far3 = get_tar(neg_predicts[far3_idx], pos_predicts)
+    far3 = get_tar(neg_predicts[far3_idx])
     far2_idx = int(len(neg_predicts)-1-len(neg_predicts)*1e-2)
-    far2 = get_tar(neg_predicts[far2_idx], pos_predicts)
-    
-    auc = 0
-    n = len(pos_predicts) - 1
-    for threshold in reversed(neg_predicts):
-        while 0 <= n and threshold <= pos_predicts[n]:
-            n -= 1
-        auc += len(pos_predicts) - 1 - n
-    auc /= len(pos_predicts) * len(neg_predicts)
+    far2 = get_tar(neg_predicts[far2_idx])
+
+    # every negative counts the positives scored at least as high as itself
+    pos_above = len(pos_predicts) - np.searchsorted(pos_predicts, neg_predicts, side='left')
+    auc = int(pos_above.sum()) / (len(pos_predicts) * len(neg_predicts))
     return far3, far2, auc
 
 
@@ -219,46 +212,149 @@ def unresticted_fold_iter(dataset_path, folds_length, fold_length=1000, seed=1):
             yield get_img_name(p1, rng.randint(p1[1]+p1[2])), get_img_name(p2, rng.randint(p2[1]+p2[2])), 0
 
 
-def get_predicts(dataset_path, model_path, class_num=10574, folds_iter=resticted_fold_iter, cached=False):
-    if cached:
-        model_name = os.path.splitext(os.path.split(model_path)[1])[0]
-        feats_path = os.path.join(dataset_path, model_name+'.pkl')
-        if os.path.exists(feats_path):
-            predicts, folds_length = pickle.load(open(feats_path, 'rb'))
-            return predicts, folds_length
-    
-    predicts=[]
-    net = sphere20a(classnum=class_num)
-    net.load_state_dict(torch.load(model_path))
-    net.cuda()
-    net.eval()
-    net.feature = True
+def load_image(dataset_path, name):
+    img = cv2.imread(os.path.join(dataset_path, 'OriginalImages', name+'.jpg'), 1)
+    landmark = load_landmark(os.path.join(dataset_path, 'FacialPoints', name+'.txt'))
+    return img, landmark
+
+
+def load_aligned_images(dataset_path, names, pool):
+    # decode on the pool, solve the transforms of the whole batch at once, warp on the pool
+    imgs, landmarks = zip(*pool.map(partial(load_image, dataset_path), names))
+    imgs = np.stack(alignments(imgs, landmarks, pool))
+    imgs = np.ascontiguousarray(imgs.transpose(0, 3, 1, 2), dtype=np.float32)
+    return (imgs - 127.5) / 128.
+
+
+TTA_MODES = ['none', 'flip-concat', 'flip-mean']
+
+
+def get_features(net, dataset_path, names, tta='none', batch_size=256, num_workers=8):
+    # decode and align on a thread pool, the next batch is prepared while the net runs on the current one.
+    # tta='none' embeds the originals only, the flip modes add the mirrored faces to the same
+    # forward and concatenate or average the two embeddings
+    assert tta in TTA_MODES, 'unknown tta mode: %s' % tta
+    features = []
+    with ThreadPoolExecutor(num_workers) as pool, ThreadPoolExecutor(1) as prefetch:
+        next_imgs = prefetch.submit(load_aligned_images, dataset_path, names[:batch_size], pool)
+        for i in range(0, len(names), batch_size):
+            imgs = next_imgs.result()
+            if i + batch_size < len(names):
+                next_imgs = prefetch.submit(load_aligned_images, dataset_path, names[i+batch_size:i+batch_size*2], pool)
+            if tta != 'none':
+                imgs = np.concatenate([imgs, imgs[:, :, :, ::-1]])
+            with torch.no_grad():
+                f = net(torch.from_numpy(imgs).cuda()).cpu().numpy()
+            if tta == 'flip-concat':
+                f = np.concatenate(np.split(f, 2), axis=1)
+            elif tta == 'flip-mean':
+                f = np.mean(np.split(f, 2), axis=0)
+            features.append(f)
+    return np.concatenate(features)
+
+
+def get_weights_hash(state_dict):
+    h = hashlib.sha1()
+    for k in sorted(state_dict.keys()):
+        h.update(k.encode())
+        h.update(state_dict[k].cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def get_alignment_hash(tta='none'):
+    # everything an embedding depends on besides the weights, the image and its landmarks
+    return hashlib.sha1(json.dumps([REF_PTS, CROP_SIZE, 127.5, 128., tta]).encode()).hexdigest()
+
+
+class EmbeddingStore(object):
+    # embeddings of one checkpoint under one alignment and tta mode, stored in
+    # <root>/<weights hash>_<alignment hash>/: features.npy is a memory-mapped
+    # (capacity, dim) float32 table and index.json lists the image path of
+    # each filled row. New rows are appended, the table doubles when full.
+    def __init__(self, root, weights_hash, alignment_hash=None):
+        self.path = os.path.join(root, '%s_%s' % (weights_hash, alignment_hash or get_alignment_hash()))
+        self.features_path = os.path.join(self.path, 'features.npy')
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.keys = []
+        self.features = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.keys = json.load(f)['keys']
+            self.features = np.lib.format.open_memmap(self.features_path, mode='r+')
+        self.key_to_idx = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_to_idx
+
+    def _reserve(self, n, dim):
+        if self.features is not None and n <= len(self.features):
+            return
+        capacity = max(n, 1024 if self.features is None else 2*len(self.features))
+        os.makedirs(self.path, exist_ok=True)
+        features = np.lib.format.open_memmap(self.features_path+'.tmp', mode='w+', dtype=np.float32, shape=(capacity, dim))
+        if self.features is not None:
+            features[:len(self)] = self.features[:len(self)]
+        features.flush()
+        del features
+        self.features = None
+        os.replace(self.features_path+'.tmp', self.features_path)
+        self.features = np.lib.format.open_memmap(self.features_path, mode='r+')
+
+    def add(self, keys, features):
+        l, r = len(self), len(self)+len(keys)
+        self._reserve(r, features.shape[1])
+        self.features[l:r] = features
+        self.features.flush()
+        # the index is written last, rows it doesn't list yet are just refilled next time
+        self.keys += list(keys)
+        self.key_to_idx.update((key, i) for i, key in enumerate(keys, l))
+        with open(self.index_path+'.tmp', 'w') as f:
+            json.dump({'keys': self.keys}, f)
+        os.replace(self.index_path+'.tmp', self.index_path)
+
+    def get(self, keys):
+        return np.asarray(self.features[[self.key_to_idx[key] for key in keys]])
+
+
+def get_predicts(dataset_path, model_path, class_num=10574, folds_iter=resticted_fold_iter, tta='none', cached=False, cache_root=None):
+    # with cached=True embeddings are kept in an EmbeddingStore under cache_root
+    # (default <dataset_path>/embeddings), shared by every protocol run against the same weights
+    state_dict = torch.load(model_path)
 
     folds_length = []
-    for name1, name2, sameflag in folds_iter(dataset_path, folds_length):
-        img1 = os.path.join(dataset_path, 'OriginalImages', name1+'.jpg')
-        landmark1 = load_landmark(os.path.join(dataset_path, 'FacialPoints', name1+'.txt'))
-        img1 = alignment(cv2.imread(img1, 1), landmark1)
-        img2 = os.path.join(dataset_path, 'OriginalImages', name2+'.jpg')
-        landmark2 = load_landmark(os.path.join(dataset_path, 'FacialPoints', name2+'.txt'))
-        img2 = alignment(cv2.imread(img2, 1), landmark2)
-
-        imglist = [img1, cv2.flip(img1, 1), img2, cv2.flip(img2, 1)]
-        for i in range(len(imglist)):
-            imglist[i] = imglist[i].transpose(2, 0, 1).reshape((1, 3, 112, 96))
-            imglist[i] = (imglist[i] - 127.5) / 128.
-
-        img = np.vstack(imglist)
-        with torch.no_grad():
-            img = Variable(torch.from_numpy(img).float(), volatile=True).cuda()
-            output = net(img)
-        f = output.data
-        f1, f2 = f[0], f[2]
-        cosdistance = f1.dot(f2) / (f1.norm() * f2.norm() + 1e-5)
-        predicts.append((cosdistance, sameflag))
-    predicts = np.array(predicts)
+    pairs = list(folds_iter(dataset_path, folds_length))
+    names = sorted(set([name for name1, name2, _ in pairs for name in (name1, name2)]))
+    keys = [os.path.abspath(os.path.join(dataset_path, 'OriginalImages', name+'.jpg')) for name in names]
+
+    # phase one: every image shared by several pairs is aligned and embedded only once
+    store = None
+    missing = list(zip(names, keys))
     if cached:
-        pickle.dump((predicts, folds_length), open(feats_path, 'wb'))
+        store = EmbeddingStore(cache_root or os.path.join(dataset_path, 'embeddings'), get_weights_hash(state_dict), get_alignment_hash(tta))
+        missing = [(name, key) for name, key in missing if key not in store]
+    if missing:
+        net = sphere20a(classnum=class_num)
+        net.load_state_dict(state_dict)
+        net.cuda()
+        net.eval()
+        net.feature = True
+        features = get_features(net, dataset_path, [name for name, _ in missing], tta)
+    if store is not None:
+        if missing:
+            store.add([key for _, key in missing], features)
+        features = store.get(keys)
+
+    # phase two: cosine similarity of all pairs at once
+    name_to_idx = {name: i for i, name in enumerate(names)}
+    idx1 = np.array([name_to_idx[name1] for name1, _, _ in pairs])
+    idx2 = np.array([name_to_idx[name2] for _, name2, _ in pairs])
+    norms = np.linalg.norm(features, axis=1)
+    cosdistance = np.sum(features[idx1] * features[idx2], axis=1) / (norms[idx1] * norms[idx2] + 1e-5)
+    sameflag = np.array([sameflag for _, _, sameflag in pairs])
+    predicts = np.stack([cosdistance, sameflag], axis=1)
     return predicts, folds_length
 
 
@@ -288,6 +384,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='PyTorch sphereface wc')
     parser.add_argument('--wc', default='datasets/WebCaricature/original_dataset', type=str)
     parser.add_argument('--model','-m', default='codes/sphereface/sphere20a.pth', type=str)
+    parser.add_argument('--tta', default='none', choices=TTA_MODES)
+    parser.add_argument('--cached', action='store_true', help='reuse embeddings stored for the same weights')
+    parser.add_argument('--cache_root', default=None, type=str)
     parser.add_argument('--ipython', action='store_true')
     args = parser.parse_args()
 
@@ -295,6 +394,6 @@ if __name__ == "__main__":
         from IPython import embed; embed()
         exit(0)
 
-    predicts, folds_length = get_predicts(args.wc, args.model)
+    predicts, folds_length = get_predicts(args.wc, args.model, tta=args.tta, cached=args.cached, cache_root=args.cache_root)
 
     eval(predicts, folds_length)